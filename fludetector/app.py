@@ -30,7 +30,8 @@ from flask_dotenv import DotEnv
 
 from fludetector import models, scripts, forms
 from fludetector.errors import FluDetectorError
-from fludetector.models import db, get_region, REGIONS, Model, ModelScore, GoogleScore
+from fludetector.store import get_store
+from fludetector.models import db, get_region, model_summary, REGIONS, Model, ModelScore, GoogleScore
 
 app = Flask(__name__)
 env = DotEnv(app)
@@ -38,6 +39,14 @@ env = DotEnv(app)
 os.environ['GOOGLE_API_KEY'] = app.config['GOOGLE_API_KEY']
 os.environ['MODEL_ENGINE'] = app.config['MODEL_ENGINE']
 os.environ['TWITTER_ENABLED'] = app.config.get('TWITTER_ENABLED', 'False')
+os.environ['GOOGLE_FETCH_WORKERS'] = str(app.config.get('GOOGLE_FETCH_WORKERS', 4))
+os.environ['GOOGLE_REQUESTS_PER_SECOND'] = str(app.config.get('GOOGLE_REQUESTS_PER_SECOND', 1))
+for key in ('GOOGLE_CACHE_PATH', 'GOOGLE_CACHE_TTL', 'GOOGLE_CACHE_SIZE', 'RUN_CHUNK_DAYS',
+            'CALCULATOR_WORKERS', 'NATIVE_MODELS_PATH',
+            'SCORE_CACHE_SIZE', 'SCORE_CACHE_VERSION', 'CALCULATOR_SOCKET',
+            'LEGACY_HOST', 'LEGACY_MATLAB_PATH', 'LEGACY_SSH', 'CSV_IMPORT_WORKERS'):
+    if key in app.config:
+        os.environ[key] = str(app.config[key])
 
 models.init_app(app)
 scripts.init_app(app)
@@ -92,13 +101,16 @@ def get_scores_form(public=True):
     if public:
         all_models = all_models.filter_by(public=public)
     all_models = all_models.all()
-    score = None
+    summaries = model_summary(all_models)
+    model_regions = []
     for m in all_models:
-        score = m.last_score
-        if score is not None:
+        summary = summaries[m.id]
+        if summary.count:
+            region = max(summary.regions, key=lambda code: summary.regions[code].last_day)
+            model_regions = [(m, region)]
             break
-    form = forms.GetScoresWebForm(request.args, model_regions=[(score.model, score.region)])
-    return all_models, form
+    form = forms.GetScoresWebForm(request.args, model_regions=model_regions, summaries=summaries)
+    return all_models, summaries, form
 
 
 def is_admin_enabled():
@@ -107,12 +119,13 @@ def is_admin_enabled():
 
 @app.route('/')
 def home():
-    all_models, form = get_scores_form()
+    all_models, summaries, form = get_scores_form()
     scores = form.scores()
 
     return render_template(
         'home.html',
         models=all_models,
+        summaries=summaries,
         form=form,
         regions=REGIONS,
         averages=calculate_averages(scores),
@@ -123,7 +136,7 @@ def home():
 
 @app.route('/export/')
 def export():
-    all_models, form = get_scores_form()
+    all_models, summaries, form = get_scores_form()
 
     raw_scores = calculate_raw_scores(form.scores())
 
@@ -198,15 +211,16 @@ def api_models():
 @app.route('/admin/')
 @requires_auth
 def admin_home():
-    all_models, form = get_scores_form(public=False)
+    all_models, summaries, form = get_scores_form(public=False)
     scores = form.scores()
 
     return render_template(
         'admin/home.html',
         models=all_models,
+        summaries=summaries,
         form=form,
         regions=REGIONS,
-        all_model_regions=[(m, r) for m in all_models for r in m.regions],
+        all_model_regions=[(m, get_region(r)) for m in all_models for r in summaries[m.id].region_codes],
         averages=calculate_averages(scores),
         raw_scores=calculate_raw_scores(scores))
 
@@ -217,6 +231,7 @@ def admin_list_models():
     return render_template(
         'admin/model_list.html',
         models=Model.query.all(),
+        summaries=model_summary(),
         region_codes=list(REGIONS.keys()))
 
 
@@ -245,6 +260,9 @@ def admin_delete_model(id):
                 db.session.delete(term)
         db.session.delete(model)
         db.session.commit()
+        store = get_store()
+        if store is not None:
+            store.remove(id)
         flash('Model deleted!', 'success')
         return redirect(url_for('admin_list_models'))
     return render_template('admin/model_delete.html', form=form, model=model)
@@ -0,0 +1,282 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+
+
+This module benchmarks the Google pipeline without a real API key or quota.
+
+FakeTrends is a local HTTP server that answers getTimelinesForHealth like
+Google does, with made up scores and configurable latency, error rate and
+response size. run_benchmark generates a model with synthetic terms in a
+throwaway database, points the Google source at FakeTrends and times each
+stage of a run (see `flask benchmark`).
+"""
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+from flask import Flask
+from sqlalchemy import event
+
+from fludetector import models
+from fludetector.models import db, bulk_upsert, model_google_terms, refresh_score_store, GoogleTerm, Model, ModelScore
+from fludetector.sources import google
+
+PATH = '/trends/v1beta/timelinesForHealth'
+
+
+def fake_score(term, day):
+    """A made up, but repeatable, score for a term on a day"""
+    seed = zlib.crc32(term.encode('utf-8')) & 0xffff
+    return round(50 + 40 * math.sin((day.toordinal() + seed) / 29.0) + seed % 7, 2)
+
+
+class FakeTrendsHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep their connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != PATH:
+            return self.reply(404, {'error': {'code': 404, 'message': 'Not Found'}})
+        self.server.begin()
+        try:
+            self.answer(url)
+        finally:
+            self.server.end()
+
+    def answer(self, url):
+        time.sleep(self.server.latency)
+        if self.server.fail():
+            return self.reply(503, {'error': {'code': 503, 'message': 'Backend Error'}})
+
+        params = parse_qs(url.query)
+        terms = params.get('terms', [])
+        start = datetime.strptime(params['time.startDate'][0], '%Y-%m-%d').date()
+        end = datetime.strptime(params['time.endDate'][0], '%Y-%m-%d').date()
+        days = [start + timedelta(days=i) for i in xrange((end - start).days + 1)]
+        if len(terms) > google.MAX_TERMS or len(terms) * len(days) > google.MAX_POINTS:
+            return self.reply(400, {'error': {'code': 400, 'message': 'Too many points requested'}})
+
+        padding = 'x' * self.server.padding
+        lines = []
+        for term in terms:
+            term = term.decode('utf-8')
+            points = [{'date': d.strftime('%b %d %Y'), 'value': fake_score(term, d)} for d in days]
+            if padding:
+                for point in points:
+                    point['padding'] = padding
+            lines.append({'term': term, 'points': points})
+        self.reply(200, {'lines': lines})
+
+    def reply(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTrends(ThreadingMixIn, HTTPServer):
+    """A local stand-in for the getTimelinesForHealth API
+
+    latency - Seconds to wait before answering each request
+    error_rate - The fraction of requests that fail with a 503
+    padding - Extra characters added to each point, to make responses bigger
+
+    Use it as a context manager to serve on a background thread. Set
+    GOOGLE_API_ROOT to its url to use it instead of Google. It counts the
+    requests made, keeps the time each one arrived in calls, and the most that
+    were being answered at once in most_active.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, error_rate=0, padding=0, seed=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeTrendsHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.padding = padding
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.calls = []
+        self.active = 0
+        self.most_active = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def begin(self):
+        with self.lock:
+            self.requests += 1
+            self.calls.append(time.time())
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+
+    def fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class BenchmarkCalculator(object):
+    """Stands in for Matlab/Octave, a fixed linear model over the averages"""
+    conf = None
+
+    def calculateModelScore(self, model, averages):
+        return sum(avg * (i % 3 + 1) for i, (term, avg) in enumerate(averages)) / len(averages)
+
+    def calculateModelScores(self, model, days_averages):
+        return [self.calculateModelScore(model, averages) for averages in days_averages]
+
+
+def generate_model(n_terms, window_size=7):
+    """Add a Google model with n_terms synthetic terms, and return it"""
+    model = Model(
+        name='Benchmark %d terms' % n_terms, type='google', public=False,
+        data='benchmark,%d' % window_size)
+    db.session.add(model)
+    db.session.flush()
+    terms = [GoogleTerm(term='benchmark term %d' % i) for i in xrange(n_terms)]
+    db.session.add_all(terms)
+    db.session.flush()
+    db.session.execute(model_google_terms.insert(), [
+        {'model_id': model.id, 'google_term_id': t.id} for t in terms])
+    db.session.commit()
+    return model
+
+
+@contextmanager
+def environ(**values):
+    """Temporarily set environment variables"""
+    previous = dict((k, os.environ.get(k)) for k in values)
+    os.environ.update((k, str(v)) for k, v in values.iteritems())
+    try:
+        yield
+    finally:
+        for k, v in previous.iteritems():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+
+class Stages(object):
+    """Times named stages, and counts the SQL statements and fake API
+    requests made during each one"""
+
+    def __init__(self, server):
+        self.server = server
+        self.results = OrderedDict()
+        self.statements = 0
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.statements += 1
+
+    @contextmanager
+    def stage(self, name):
+        statements, requests, began = self.statements, self.server.requests, time.time()
+        yield
+        self.results[name] = {
+            'seconds': time.time() - began,
+            'queries': self.statements - statements,
+            'requests': self.server.requests - requests
+        }
+
+    def close(self):
+        event.remove(db.engine, 'before_cursor_execute', self.count)
+
+
+def run_benchmark(n_terms, n_days, latency=0, error_rate=0, padding=0, workers=4, window_size=7):
+    """Run the Google pipeline for n_terms over n_days against FakeTrends, in
+    a throwaway database, and return the wall time, SQL statements and API
+    requests of each stage"""
+    path = tempfile.mkdtemp(prefix='fludetector-benchmark.')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % os.path.join(path, 'benchmark.db')
+    app.config['SCORE_STORE_PATH'] = os.path.join(path, 'store')
+    models.init_app(app)
+    services = google.services
+    try:
+        with app.app_context(), FakeTrends(latency, error_rate, padding) as server, environ(
+                GOOGLE_API_ROOT=server.url,
+                GOOGLE_API_KEY=os.environ.get('GOOGLE_API_KEY', 'benchmark'),
+                GOOGLE_FETCH_WORKERS=workers,
+                GOOGLE_REQUESTS_PER_SECOND=1000):
+            # Clients built for the real API can't be reused
+            google.services = google.ServicePool()
+            db.session.remove()
+            db.create_all()
+            model = generate_model(n_terms, window_size)
+            end = date.today() - timedelta(days=2)
+            start = end - timedelta(days=n_days - 1)
+
+            stages = Stages(server)
+            try:
+                with stages.stage('collection'):
+                    google.collect(model, start, end)
+                with stages.stage('averaging'):
+                    google.moving_average_matrix(model, start, end)
+                # The same calls as a run, so this includes averaging again,
+                # and the score cache if SCORE_CACHE_SIZE is set
+                with stages.stage('calculation'):
+                    scores = list(google.calculate_model_scores(model, start, end, BenchmarkCalculator()))
+                with stages.stage('commit'):
+                    bulk_upsert(ModelScore, scores)
+                    db.session.commit()
+                    refresh_score_store(model, start, end)
+            finally:
+                stages.close()
+                google.services.close()
+            db.session.remove()
+            db.get_engine(app).dispose()
+            return stages.results
+    finally:
+        google.services = services
+        shutil.rmtree(path)
@@ -0,0 +1,212 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+
+
+This module keeps an optional on-disk cache of raw API responses, so that
+reruns don't spend quota downloading the same data again.
+
+Each response is a JSON file in the cache directory, named after a hash of
+the request (see request_key). Files older than the TTL are ignored and
+removed, and once the directory is bigger than its size limit the least
+recently used files are removed until it fits again.
+
+It also keeps an optional cache of the values model functions calculate, in
+the cached_model_score table, so that reruns don't pay for Matlab/Octave to
+calculate the same thing again (see ScoreCache).
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from fludetector.models import db, bulk_upsert, CachedModelScore
+
+DEFAULT_TTL = 30 * 24 * 60 * 60
+DEFAULT_SIZE = 1024 * 1024 * 1024
+# The most values looked up in one query, SQLite allows 999 parameters
+LOOKUP_SIZE = 500
+# The ScoreCache is let grow by up to 1/EVICT_SLACK of its size between evictions
+EVICT_SLACK = 10
+
+
+def request_key(terms, start, end, region):
+    """Hash a request, the order of the terms doesn't matter"""
+    request = json.dumps([sorted(terms), start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), region])
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+def get_response_cache():
+    """Return the ResponseCache, or None if GOOGLE_CACHE_PATH isn't configured"""
+    path = os.environ.get('GOOGLE_CACHE_PATH')
+    if path:
+        return ResponseCache(
+            path,
+            ttl=int(os.environ.get('GOOGLE_CACHE_TTL', DEFAULT_TTL)),
+            size=int(os.environ.get('GOOGLE_CACHE_SIZE', DEFAULT_SIZE)))
+
+
+class ResponseCache(object):
+
+    def __init__(self, path, ttl=DEFAULT_TTL, size=DEFAULT_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+
+    def entry(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key, expire=True):
+        """Return the cached response for key, or None if there isn't one
+
+        With expire=False, responses older than the TTL are still returned.
+        """
+        path = self.entry(key)
+        try:
+            if expire and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path) as fd:
+                response = json.load(fd)
+            # Mark it as recently used, without changing its age
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            return response
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, response):
+        """Cache the response for key, then evict anything over the limits"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Write then rename, so other threads and processes never read half a file
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(response, f)
+        os.rename(tmp, self.entry(key))
+        self.evict()
+
+    def evict(self):
+        """Remove expired responses, then the least recently used ones until
+        the cache is within its size limit"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime > self.ttl:
+                    os.remove(path)
+                else:
+                    entries.append((stat.st_atime, stat.st_size, path))
+            except OSError:
+                pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def score_key(function, averages):
+    """Hash a model function's inputs, along with SCORE_CACHE_VERSION so that
+    changing it invalidates everything calculated before
+
+    The engine isn't part of the key, the engines run the same functions, so
+    e.g. runs through the calculator daemon share values with local runs.
+    """
+    inputs = json.dumps([
+        function, os.environ.get('SCORE_CACHE_VERSION', '1'),
+        [[term, repr(avg)] for term, avg in averages]])
+    return hashlib.sha256(inputs.encode('utf-8')).hexdigest()
+
+
+score_caches = {}
+
+
+def get_score_cache():
+    """Return the process's ScoreCache, or None if SCORE_CACHE_SIZE isn't
+    configured"""
+    size = int(os.environ.get('SCORE_CACHE_SIZE', 0))
+    if size > 0:
+        if size not in score_caches:
+            score_caches[size] = ScoreCache(size)
+        return score_caches[size]
+
+
+class ScoreCache(object):
+    """Model function values, keyed by score_key, at most size of them (plus
+    up to 1/EVICT_SLACK more between evictions)
+
+    Changes go through the session, so they're committed with the scores.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # Other processes may have filled it, so the first write evicts
+        self.written = size
+
+    def get_many(self, keys):
+        """Return a dict of the cached value for each of keys there is one for"""
+        keys = list(set(keys))
+        now = datetime.utcnow()
+        values = {}
+        for i in xrange(0, len(keys), LOOKUP_SIZE):
+            chunk = keys[i:i + LOOKUP_SIZE]
+            values.update(db.session.query(CachedModelScore.key, CachedModelScore.value).filter(
+                CachedModelScore.key.in_(chunk)))
+        hits = list(values)
+        for i in xrange(0, len(hits), LOOKUP_SIZE):
+            # Mark them as recently used
+            db.session.query(CachedModelScore).filter(
+                CachedModelScore.key.in_(hits[i:i + LOOKUP_SIZE])).update({'used': now}, synchronize_session=False)
+        return values
+
+    def put_many(self, function, values):
+        """Cache a dict of key to value for function, evicting the least
+        recently used over the limit once enough have been written since the
+        last time, rather than counting them on every write"""
+        now = datetime.utcnow()
+        bulk_upsert(CachedModelScore, (
+            {'key': key, 'function': function, 'value': value, 'used': now}
+            for key, value in values.iteritems()))
+        self.written += len(values)
+        if self.written >= max(1, self.size // EVICT_SLACK):
+            self.evict()
+
+    def evict(self):
+        self.written = 0
+        over = db.session.query(CachedModelScore).count() - self.size
+        if over > 0:
+            oldest = db.session.query(CachedModelScore.key).order_by(
+                CachedModelScore.used, CachedModelScore.key).limit(over)
+            db.session.query(CachedModelScore).filter(
+                CachedModelScore.key.in_(oldest.subquery())).delete(synchronize_session=False)
+
+
+def clear_scores(function):
+    """Remove every cached value of a model function, returning how many"""
+    return db.session.query(CachedModelScore).filter(
+        CachedModelScore.function == function).delete(synchronize_session=False)
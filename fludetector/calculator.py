@@ -17,8 +17,29 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
+import json
+import multiprocessing
+import os
+import pipes
+import select
+import socket
+import tarfile
+import uuid
+from collections import defaultdict, deque
 from enum import Enum
+from functools import partial
 import tempfile
+from StringIO import StringIO
+
+import numpy as np
+import sh
+
+from fludetector.errors import FluDetectorError
+from fludetector.gp import GaussianProcesses
+from fludetector.log import logger
+
+MAX_RESTARTS = 3
+DEFAULT_SOCKET = '/tmp/fludetector-calculator.sock'
 
 
 def buildCalculator(calculatorType):
@@ -27,17 +48,87 @@ def buildCalculator(calculatorType):
     if calculatorType is CalculatorType.REMOTE:
         return RemoteCalculator()
     if calculatorType is CalculatorType.OCTAVE:
-        import sys
-        if 'oct2py' not in sys.modules:
-            global octave
-            from oct2py import octave
-            octave.cd("octave")
-            octave.run("gpml/startup.m")
         return LocalOctave()
+    if calculatorType is CalculatorType.NATIVE:
+        return LocalNative()
+    if calculatorType is CalculatorType.LEGACY:
+        return LegacyMatlab()
+
+
+def calculator_socket():
+    """Return the path of the calculator daemon's socket"""
+    return os.environ.get('CALCULATOR_SOCKET', DEFAULT_SOCKET)
+
+
+def calculator_workers():
+    """Return the number of calculator processes to run models with"""
+    return int(os.environ.get('CALCULATOR_WORKERS', 1))
+
+
+pools = {}
+
+
+def buildCalculatorPool(calculatorType, workers):
+    """Return the process's CalculatorPool for this type of calculator,
+    starting it the first time"""
+    if calculatorType not in pools:
+        pools[calculatorType] = CalculatorPool(partial(buildCalculator, calculatorType), workers)
+        pools[calculatorType].conf = calculatorType
+    return pools[calculatorType]
 
 
 class CalculatorType(Enum):
-    MATLAB, REMOTE, LEGACY, OCTAVE = range(4)
+    MATLAB, REMOTE, LEGACY, OCTAVE, NATIVE = range(5)
+
+
+# Matlab/Octave functions shared by the local engines
+ENGINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'engines')
+
+
+def write_averages(fh, averages):
+    """Write one day's averages as the term,average lines model functions read,
+    in full precision"""
+    fh.write('\n'.join('%s,%.17g' % a for a in averages))
+    fh.flush()
+
+
+def averages_matrix(days_averages):
+    """Return the terms in these days' averages, and an array with a row of
+    averages for each day and a column for each term, NaN where missing"""
+    terms = []
+    for averages in days_averages:
+        for term, avg in averages:
+            if term not in terms:
+                terms.append(term)
+    columns = dict((term, j) for j, term in enumerate(terms))
+    X = np.full((len(days_averages), len(terms)), np.nan)
+    for i, averages in enumerate(days_averages):
+        for term, avg in averages:
+            X[i, columns[term]] = avg
+    return terms, X
+
+
+def write_averages_matrix(fh, days_averages):
+    """Write many days' averages as fludetector_scores reads them, the terms on
+    the first line then a line for each day, with NaN for missing averages
+
+    The averages are written in full precision, the same as
+    fludetector_score_values.m passes them on, so every engine gets the same
+    inputs.
+    """
+    terms, X = averages_matrix(days_averages)
+    fh.write(','.join(terms) + '\n')
+    for row in X:
+        fh.write(','.join('NaN' if np.isnan(avg) else '%.17g' % avg for avg in row) + '\n')
+    fh.flush()
+
+
+def read_scores(fh, days):
+    """Read the scores fludetector_scores wrote for this many days"""
+    scores = [float(line) for line in fh.read().split()]
+    if len(scores) != days:
+        raise FluDetectorError('Expected %d scores but got %d' % (days, len(scores)))
+    return scores
 
 
 class LocalMatlab(object):
@@ -46,6 +137,7 @@ class LocalMatlab(object):
         import matlab.engine
         self.conf = CalculatorType.MATLAB
         self.engine = matlab.engine.start_matlab("-nodisplay -nojvm")
+        self.engine.addpath(ENGINES_PATH, nargout=0)
         self.engine.cd("matlab")
         self.engine.run("gpml/startup.m", nargout=0)
 
@@ -53,35 +145,351 @@ class LocalMatlab(object):
         self.engine.quit()
 
     def calculateModelScore(self, model, averages):
+        return self.calculate(model.get_data()['matlab_function'], averages)
+
+    def calculateModelScores(self, model, days_averages):
+        """Score each day's averages in a single call to Matlab"""
+        return self.calculateMany(model.get_data()['matlab_function'], days_averages)
+
+    def calculate(self, function, averages):
         fhin = tempfile.NamedTemporaryFile(prefix='fludetector-matlab-input.')
         fhout = tempfile.NamedTemporaryFile(prefix='fludetector-matlab-output.')
-        fhin.write('\n'.join('%s,%f' % a for a in averages))
-        fhin.flush()
+        write_averages(fhin, averages)
         self.engine.evalc("fin = '%s'" % fhin.name, nargout=0)
         self.engine.evalc("fout = '%s'" % fhout.name, nargout=0)
-        self.engine.run("%s(fin,fout)" % model.get_data()['matlab_function'], nargout=0)
+        self.engine.run("%s(fin,fout)" % function, nargout=0)
         value = float(open(fhout.name).read().strip())
         fhin.close()
         fhout.close()
         return value
 
+    def calculateMany(self, function, days_averages):
+        if not days_averages:
+            return []
+        fhin = tempfile.NamedTemporaryFile(prefix='fludetector-matlab-input.')
+        fhout = tempfile.NamedTemporaryFile(prefix='fludetector-matlab-output.')
+        write_averages_matrix(fhin, days_averages)
+        self.engine.evalc("fludetector_scores('%s','%s','%s')" % (function, fhin.name, fhout.name), nargout=0)
+        scores = read_scores(open(fhout.name), len(days_averages))
+        fhin.close()
+        fhout.close()
+        return scores
+
+
+class LegacyMatlab(object):
+    """Runs Matlab on another server over ssh, a whole batch of days at a time
+
+    The days' averages and the fludetector_scores functions are uploaded in
+    one tar archive to a directory of their own (so runs can't get in each
+    other's way), Matlab is started once to score them all, and the scores are
+    read back in one go. All of it goes over one multiplexed ssh connection.
+
+    LEGACY_HOST - The server to run Matlab on
+    LEGACY_MATLAB_PATH - The directory on it with the models and gpml
+    LEGACY_SSH - The ssh command to use
+    """
+
+    def __init__(self):
+        self.conf = CalculatorType.LEGACY
+        self.path = os.environ.get('LEGACY_MATLAB_PATH', '/home/vlampos/website_v2')
+        self.ssh = sh.Command(os.environ.get('LEGACY_SSH', 'ssh')).bake(
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % os.path.join(tempfile.gettempdir(), 'fludetector-ssh-%r@%h:%p'),
+            '-o', 'ControlPersist=60',
+            os.environ.get('LEGACY_HOST', 'fmedia13'))
+
+    def calculateModelScore(self, model, averages):
+        return self.calculate(model.get_data()['matlab_function'], averages)
+
+    def calculateModelScores(self, model, days_averages):
+        return self.calculateMany(model.get_data()['matlab_function'], days_averages)
+
+    def calculate(self, function, averages):
+        return self.calculateMany(function, [averages])[0]
+
+    def archive(self, days_averages):
+        """A tar archive of the averages and the functions that score them"""
+        fh = StringIO()
+        archive = tarfile.open(fileobj=fh, mode='w')
+        for name in ('fludetector_scores.m', 'fludetector_score_values.m'):
+            archive.add(os.path.join(ENGINES_PATH, name), name)
+        averages = StringIO()
+        write_averages_matrix(averages, days_averages)
+        info = tarfile.TarInfo('averages.csv')
+        info.size = len(averages.getvalue())
+        averages.seek(0)
+        archive.addfile(info, averages)
+        archive.close()
+        return fh.getvalue()
+
+    def calculateMany(self, function, days_averages):
+        if not days_averages:
+            return []
+        remote = pipes.quote('/tmp/fludetector-%s' % uuid.uuid4().hex)
+        logger.debug('Sending %d days of averages to %s' % (len(days_averages), remote))
+        self.ssh('mkdir -p %s && tar -xf - -C %s' % (remote, remote), _in=self.archive(days_averages))
+        try:
+            run = ';'.join([
+                "cd %s" % self.path,
+                "run('gpml/startup.m')",
+                "addpath('%s')" % remote,
+                "try, fludetector_scores('%s','%s/averages.csv','%s/scores.txt')" % (function, remote, remote),
+                "catch e, disp(getReport(e)), exit(1), end",
+                "exit"])
+            logger.debug('Running matlab function over scores')
+            self.ssh('matlab', '-nodisplay', '-nojvm', '-r', '"%s"' % run)
+            logger.debug('Reading matlab results back')
+            scores = self.ssh('cat %s/scores.txt' % remote).stdout
+        finally:
+            # Don't let a failed cleanup hide why matlab failed
+            try:
+                self.ssh('rm -rf %s' % remote)
+            except sh.ErrorReturnCode as e:
+                logger.warn('Could not remove %s: %s' % (remote, e))
+        return read_scores(StringIO(scores), len(days_averages))
+
+
+def send_message(fh, message):
+    """Write a message of the calculator daemon's protocol, a line of JSON"""
+    fh.write(json.dumps(message) + '\n')
+    fh.flush()
+
+
+def read_message(fh):
+    """Read a message of the calculator daemon's protocol, None at the end"""
+    line = fh.readline()
+    if line:
+        return json.loads(line)
+
 
 class RemoteCalculator(object):
-    pass
+    """A client of the calculator daemon (see fludetector/daemon.py), which
+    keeps engines warmed up between runs"""
+
+    def __init__(self, path=None):
+        self.conf = CalculatorType.REMOTE
+        self.path = path or calculator_socket()
+
+    def calculateModelScore(self, model, averages):
+        return self.calculate(model.get_data()['matlab_function'], averages)
+
+    def calculateModelScores(self, model, days_averages):
+        return self.calculateMany(model.get_data()['matlab_function'], days_averages)
+
+    def calculate(self, function, averages):
+        return self.calculateMany(function, [averages])[0]
+
+    def calculateMany(self, function, days_averages):
+        if not days_averages:
+            return []
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            sock.close()
+            raise FluDetectorError('Couldn\'t connect to the calculator daemon at %s: %s' % (self.path, e))
+        fh = sock.makefile('rw')
+        try:
+            send_message(fh, {'function': function, 'days': days_averages})
+            response = read_message(fh)
+        finally:
+            fh.close()
+            sock.close()
+        if response is None:
+            raise FluDetectorError('The calculator daemon hung up')
+        if 'error' in response:
+            raise FluDetectorError('The calculator daemon failed: %s' % response['error'])
+        return response['scores']
 
 
 class LocalOctave(object):
 
     def __init__(self):
         self.conf = CalculatorType.OCTAVE
+        self.session = None
+
+    def octave(self):
+        """Start this calculator's own Octave session on first use.
+
+        Pool workers build their calculator after forking, so starting the
+        session here rather than in __init__ or at import time gives each
+        worker a session of its own instead of sharing the parent's pipes.
+        """
+        if self.session is None:
+            from oct2py import Oct2Py
+            self.session = Oct2Py()
+            self.session.addpath(ENGINES_PATH)
+            self.session.cd("octave")
+            self.session.run("gpml/startup.m")
+        return self.session
 
     def calculateModelScore(self, model, averages):
-        fhin = tempfile.NamedTemporaryFile(prefix='fludetector-matlab-input.')
-        fhout = tempfile.NamedTemporaryFile(prefix='fludetector-matlab-output.')
-        fhin.write('\n'.join('%s,%f' % a for a in averages))
-        fhin.flush()
-        octave.eval("%s('%s','%s')" % (model.get_data()['matlab_function'], fhin.name, fhout.name))
-        value = float(open(fhout.name).read().strip())
-        fhin.close()
-        fhout.close()
-        return value
+        return self.calculate(model.get_data()['matlab_function'], averages)
+
+    def calculateModelScores(self, model, days_averages):
+        """Score each day's averages in a single call to Octave"""
+        return self.calculateMany(model.get_data()['matlab_function'], days_averages)
+
+    def calculate(self, function, averages):
+        return self.calculateMany(function, [averages])[0]
+
+    def calculateMany(self, function, days_averages):
+        """Pass the averages to Octave as a cell array of terms and a matrix,
+        and get the scores straight back, without any files"""
+        if not days_averages:
+            return []
+        terms, X = averages_matrix(days_averages)
+        scores = np.asarray(self.octave().feval('fludetector_score_values', function, terms, X), dtype=float).ravel()
+        if len(scores) != len(days_averages):
+            raise FluDetectorError('Expected %d scores but got %d' % (len(days_averages), len(scores)))
+        return [float(score) for score in scores]
+
+
+class LocalNative(object):
+    """Scores models exported to NATIVE_MODELS_PATH in Python, see
+    fludetector/gp.py"""
+
+    def __init__(self):
+        self.conf = CalculatorType.NATIVE
+        self.models = GaussianProcesses(os.environ.get('NATIVE_MODELS_PATH', 'native'))
+
+    def calculateModelScore(self, model, averages):
+        return self.calculate(model.get_data()['matlab_function'], averages)
+
+    def calculateModelScores(self, model, days_averages):
+        return self.calculateMany(model.get_data()['matlab_function'], days_averages)
+
+    def calculate(self, function, averages):
+        return self.calculateMany(function, [averages])[0]
+
+    def calculateMany(self, function, days_averages):
+        if not days_averages:
+            return []
+        gp = self.models.get(function)
+        return [float(score) for score in gp.predict(gp.inputs(days_averages))]
+
+
+def work(build, conn):
+    """The loop each CalculatorPool worker process runs"""
+    calculator = build()
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        function, days_averages = task
+        try:
+            conn.send((True, calculator.calculateMany(function, days_averages)))
+        except Exception as e:
+            conn.send((False, repr(e)))
+
+
+class CalculatorPool(object):
+    """Long lived worker processes, each with its own calculator
+
+    build - Makes a calculator, it's called once in each worker, so Matlab or
+        Octave is only started and warmed up once per worker
+    workers - The number of worker processes
+
+    The days to score are split between the workers, which each score their
+    share in one call to their calculator. Each worker has its own pipe, so
+    one dying can't take the others down with it. Workers that die are
+    restarted, and their days are given to another.
+    """
+
+    def __init__(self, build, workers):
+        self.build = build
+        self.workers = [self.start() for i in xrange(workers)]
+
+    def start(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=work, args=(self.build, child_conn))
+        process.daemon = True
+        process.start()
+        # Only the worker should have its end open, so its death is an EOF
+        child_conn.close()
+        return process, conn
+
+    def calculateModelScore(self, model, averages):
+        return self.calculateModelScores(model, [averages])[0]
+
+    def calculateModelScores(self, model, days_averages):
+        return self.calculateMany(model.get_data()['matlab_function'], days_averages)
+
+    def calculateMany(self, function, days_averages):
+        """Calculate a score from each day's averages, in parallel, returning
+        the scores in the same order"""
+        size = max(1, -(-len(days_averages) // len(self.workers)))
+        todo = deque((i, days_averages[i:i + size]) for i in xrange(0, len(days_averages), size))
+        values = [None] * len(days_averages)
+        restarts = defaultdict(int)
+        busy = {}
+        while todo or busy:
+            for index in xrange(len(self.workers)):
+                if todo and index not in busy:
+                    i, share = todo.popleft()
+                    try:
+                        # Workers can die while they're idle too
+                        if not self.workers[index][0].is_alive():
+                            raise IOError('Calculator worker %d is not running' % index)
+                        self.workers[index][1].send((function, share))
+                    except IOError:
+                        self.restart(index)
+                        restarts[i] += 1
+                        if restarts[i] > MAX_RESTARTS:
+                            self.drain(busy)
+                            raise FluDetectorError('Calculator workers keep dying on the same days')
+                        todo.appendleft((i, share))
+                        continue
+                    busy[index] = i, share
+            if not busy:
+                continue
+
+            conns = dict((self.workers[index][1].fileno(), index) for index in busy)
+            readable, _, _ = select.select(conns.keys(), [], [])
+            for fileno in readable:
+                index = conns[fileno]
+                i, share = busy.pop(index)
+                try:
+                    ok, value = self.workers[index][1].recv()
+                except (EOFError, IOError):
+                    self.restart(index)
+                    restarts[i] += 1
+                    if restarts[i] > MAX_RESTARTS:
+                        self.drain(busy)
+                        raise FluDetectorError('Calculator workers keep dying on the same days')
+                    todo.appendleft((i, share))
+                    continue
+                if not ok:
+                    self.drain(busy)
+                    raise FluDetectorError('Calculating a %s score failed: %s' % (function, value))
+                values[i:i + len(share)] = value
+        return values
+
+    def drain(self, busy):
+        """Throw away the results of the days still being calculated, so the
+        next call doesn't get them"""
+        for index in busy:
+            try:
+                self.workers[index][1].recv()
+            except (EOFError, IOError):
+                self.restart(index)
+
+    def restart(self, index):
+        process, conn = self.workers[index]
+        conn.close()
+        process.join()
+        logger.warn('Calculator worker %d died (exit code %s), restarting it' % (index, process.exitcode))
+        self.workers[index] = self.start()
+
+    def close(self):
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+            except IOError:
+                pass
+            conn.close()
+        for process, conn in self.workers:
+            process.join()
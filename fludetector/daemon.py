@@ -0,0 +1,135 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+
+
+A long running calculator service, so Matlab/Octave are started and warmed up
+once rather than by every run (see `flask runcalculator`).
+
+It listens on a Unix socket (CALCULATOR_SOCKET) and keeps a CalculatorPool of
+engines. Clients (RemoteCalculator, used when MODEL_ENGINE is remote) send a
+line of JSON for each job:
+
+    {"function": "matlab_function", "days": [[["term", 1.5], ...], ...]}
+
+and get a line back, either {"scores": [...]}, a score for each day in the same
+order, or {"error": "..."}. The pool spreads each job's days over all of its
+workers, so jobs are run one at a time and connections are served in turn. A
+connection can send any number of jobs, but holds up everyone else until it's
+closed, so RemoteCalculator opens a new one for each job.
+
+The socket is only accessible to the user running the daemon.
+"""
+import os
+import socket
+from functools import partial
+from SocketServer import StreamRequestHandler, UnixStreamServer
+
+from fludetector.calculator import (
+    buildCalculator, read_message, send_message, CalculatorPool, CalculatorType)
+from fludetector.errors import FluDetectorError
+from fludetector.log import logger
+
+ENGINES = {
+    'matlab': CalculatorType.MATLAB,
+    'octave': CalculatorType.OCTAVE,
+    'native': CalculatorType.NATIVE,
+}
+
+
+class FakeEngine(object):
+    """Stands in for Matlab/Octave so the daemon can be run without them,
+    each score is the sum of the day's averages, and the function 'fail'
+    always fails"""
+
+    def calculate(self, function, averages):
+        if function == 'fail':
+            raise ValueError('%s failed' % function)
+        return sum(avg for term, avg in averages)
+
+    def calculateMany(self, function, days_averages):
+        return [self.calculate(function, averages) for averages in days_averages]
+
+
+def build_engine(name):
+    """Return the function that builds the calculator the engine is named after"""
+    if name == 'fake':
+        return FakeEngine
+    return partial(buildCalculator, ENGINES[name])
+
+
+def is_listening(path):
+    """Return whether something accepts connections on the Unix socket at path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class CalculatorHandler(StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            job = read_message(self.rfile)
+            if job is None:
+                return
+            send_message(self.wfile, self.server.score(job))
+
+
+class CalculatorDaemon(UnixStreamServer):
+    """Serves scoring jobs on the Unix socket at path, one connection at a
+    time, with a pool of workers engines built by build"""
+
+    def __init__(self, path, build, workers=1):
+        if os.path.exists(path):
+            if is_listening(path):
+                raise FluDetectorError('A calculator daemon is already running on %s' % path)
+            # Left behind by a daemon that didn't shut down cleanly
+            os.remove(path)
+        UnixStreamServer.__init__(self, path, CalculatorHandler)
+        self.path = path
+        self.pool = CalculatorPool(build, workers)
+
+    def server_bind(self):
+        # Created accessible to this user only, rather than changed afterwards
+        umask = os.umask(0o177)
+        try:
+            UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def score(self, job):
+        try:
+            function = job['function']
+            days_averages = [[tuple(a) for a in averages] for averages in job['days']]
+            scores = self.pool.calculateMany(function, days_averages)
+            logger.info('Calculated %d %s scores' % (len(scores), function))
+            return {'scores': scores}
+        except Exception as e:
+            logger.exception(e)
+            return {'error': str(e)}
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        self.pool.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
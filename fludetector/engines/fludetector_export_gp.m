@@ -0,0 +1,31 @@
+function fludetector_export_gp(fout, terms, x, y, hyp, ard)
+% FLUDETECTOR_EXPORT_GP Exports a GPML model for the native engine
+%   Writes the training data and hyperparameters of a model trained with
+%   GPML's infExact, likGauss, meanZero or meanConst and covSEiso (or covSEard
+%   if ard is true) to fout, as fludetector/gp.py reads them. Name the file
+%   after the model's matlab_function, e.g. native/<function>.json.
+%
+%   terms is a cell array naming the columns of x. Needs jsonencode, Matlab
+%   R2016b or Octave 7 onwards.
+if nargin < 6
+    ard = false;
+end
+model.terms = terms;
+model.X = x;
+model.y = y(:)';
+model.mean = 0;
+if isfield(hyp, 'mean') && ~isempty(hyp.mean)
+    model.mean = hyp.mean;
+end
+model.lik = hyp.lik;
+if ard
+    type = 'SEard';
+else
+    type = 'SEiso';
+end
+model.cov = {struct('type', type, 'hyp', hyp.cov(:)')};
+
+fid = fopen(fout, 'w');
+fprintf(fid, '%s', jsonencode(model));
+fclose(fid);
+end
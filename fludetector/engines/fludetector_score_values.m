@@ -0,0 +1,32 @@
+function y = fludetector_score_values(fname, terms, X)
+% FLUDETECTOR_SCORE_VALUES Scores many days of a model, returning the scores
+%   terms is a cell array of the model's terms, and X has a row of averages
+%   for each day, a column for each term, with NaN where a term has no
+%   average. The days are scored all at once with fname_batch(terms, X) if
+%   the model has one, otherwise one at a time with fname(fin, fout).
+%
+%   This runs in both Matlab and Octave.
+batch = [fname '_batch'];
+if exist(batch) == 2
+    y = feval(batch, terms, X);
+    y = y(:);
+    return
+end
+
+y = zeros(size(X, 1), 1);
+tin = tempname();
+tout = tempname();
+for i = 1:size(X, 1)
+    fid = fopen(tin, 'w');
+    for j = find(~isnan(X(i, :)))
+        fprintf(fid, '%s,%.17g\n', terms{j}, X(i, j));
+    end
+    fclose(fid);
+    feval(fname, tin, tout);
+    fid = fopen(tout, 'r');
+    y(i) = fscanf(fid, '%f', 1);
+    fclose(fid);
+end
+delete(tin);
+delete(tout);
+end
@@ -0,0 +1,20 @@
+function fludetector_scores(fname, fin, fout)
+% FLUDETECTOR_SCORES Scores many days of a model in one call
+%   fin has the model's terms on its first line, then a line of averages for
+%   each day, with NaN where a term has no average. The days are scored by
+%   fludetector_score_values, and the scores written to fout, one a line, in
+%   the same order as the days.
+%
+%   This runs in both Matlab and Octave.
+fid = fopen(fin, 'r');
+terms = strsplit(fgetl(fid), ',');
+C = textscan(fid, repmat('%f', 1, numel(terms)), 'Delimiter', ',');
+fclose(fid);
+X = [C{:}];
+
+y = fludetector_score_values(fname, terms, X);
+
+fid = fopen(fout, 'w');
+fprintf(fid, '%.17g\n', y);
+fclose(fid);
+end
@@ -17,13 +17,17 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
+import os
+import tempfile
 from datetime import timedelta
 from dateutil.relativedelta import relativedelta
+from flask import request
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileRequired
+from flask_wtf.file import FileField
 from wtforms import Form, DateField, SelectField, StringField, IntegerField, FieldList, ValidationError, BooleanField, TextAreaField
 from wtforms.validators import InputRequired, DataRequired, NumberRange
 from sqlalchemy.orm.exc import NoResultFound
+from werkzeug.utils import secure_filename
 
 from fludetector.models import Model, REGIONS, GoogleTerm, TwitterNgram
 
@@ -151,7 +155,7 @@ class GetScoresForm(Form):
     end = DateField('End', validators=[DataRequired()])
     resolution = SelectField(
         'Resolution',
-        choices=[('day', 'Day'), ('week', 'Week')],
+        choices=[('day', 'Day'), ('week', 'Week'), ('week_mean', 'Weekly mean'), ('month_mean', 'Monthly mean')],
         default='day')
     smoothing = SelectField(
         'Smoothing',
@@ -161,24 +165,30 @@ class GetScoresForm(Form):
 
 
 class GetScoresWebForm(GetScoresForm):
+    """summaries - The models' ModelSummaries, if they've already been fetched
+    (see model_summary), to default the dates from"""
     model_regions = FieldList(ModelRegionField('Model-Region'))
 
     def __init__(self, *args, **kwargs):
+        summaries = kwargs.pop('summaries', None)
         super(GetScoresWebForm, self).__init__(*args, **kwargs)
-        if self.model_regions.data and not self.start.data:
-            start = self.model_regions.data[0][0].last_score.day
-            start = start - relativedelta(months=1)
-            self.start.process_data(start)
-        if self.start.data and not self.end.data:
-            end = self.model_regions.data[0][0].last_score.day
-            self.end.process_data(end)
+        last_day = None
+        if self.model_regions.data:
+            model = self.model_regions.data[0][0]
+            summary = summaries[model.id] if summaries is not None else model.summary
+            last_day = summary.last_day
+        if last_day is not None and not self.start.data:
+            self.start.process_data(last_day - relativedelta(months=1))
+        if self.start.data and not self.end.data and last_day is not None:
+            self.end.process_data(last_day)
 
     def scores(self):
         if self.validate():
             return [
-                (s, s.smoothed(self.smoothing.data))
+                score
                 for (m, r) in self.model_regions.data
-                for s in m.get_scores(self.start.data, self.end.data, r, self.resolution.data)]
+                for score in m.get_smoothed_scores(
+                    self.start.data, self.end.data, r, self.resolution.data, self.smoothing.data)]
         return []
 
 
@@ -189,20 +199,21 @@ class GetScoresApiForm(GetScoresForm):
     def __init__(self, *args, **kwargs):
         super(GetScoresApiForm, self).__init__(*args, **kwargs)
         if self.model.data and not self.start.data:
-            start = self.model.data.last_score.day
-            start = start - timedelta(days=7)
-            self.start.process_data(start)
+            # Models without any scores are left without a start, which fails validation
+            last_day = self.model.data.summary.last_day
+            if last_day is not None:
+                self.start.process_data(last_day - timedelta(days=7))
         if self.start.data and not self.end.data:
             end = self.start.data + timedelta(days=14)
             self.end.process_data(end)
 
     def scores(self):
         if self.validate():
-            scores = self.model.data.get_scores(
-                self.start.data, self.end.data, self.region.data, self.resolution.data)
+            scores = self.model.data.get_smoothed_scores(
+                self.start.data, self.end.data, self.region.data, self.resolution.data, self.smoothing.data)
             return [
-                {'date': s.day.strftime('%Y-%m-%d'), 'score': s.smoothed(self.smoothing.data)}
-                for s in scores]
+                {'date': s.day.strftime('%Y-%m-%d'), 'score': smoothed}
+                for s, smoothed in scores]
 
 
 class DeleteModelForm(FlaskForm):
@@ -341,15 +352,36 @@ class RunModelForm(FlaskForm):
 
 class RunCsvModelForm(RunModelForm):
     csv_file = FileField(
-        'CSV File',
-        description='The file to read data from',
-        validators=[FileRequired()])
+        'CSV Files',
+        description='The files to read data from')
+    csv_path = StringField(
+        'CSV Path',
+        description='Or a file, directory or glob of CSV files on the server to read data from')
+
+    def uploads(self):
+        return [f for f in request.files.getlist(self.csv_file.name) if f.filename]
+
+    def validate(self):
+        if not super(RunCsvModelForm, self).validate():
+            return False
+        if not self.uploads() and not self.csv_path.data:
+            self.csv_file.errors.append('Upload CSV files or give the path to them')
+            return False
+        return True
 
     def to_dict(self):
         d = super(RunCsvModelForm, self).to_dict()
-        path = '/tmp/fludetector_uploaded.csv'
-        self.csv_file.data.save(path)
-        d['csv'] = path
+        uploads = self.uploads()
+        if uploads:
+            path = tempfile.mkdtemp(prefix='fludetector-upload.')
+            for i, upload in enumerate(uploads):
+                name = os.path.splitext(secure_filename(upload.filename))[0]
+                upload.save(os.path.join(path, '%03d-%s.csv' % (i, name)))
+            d['csv'] = path
+            # runmodel deletes the uploads once it's done with them
+            d['cleanup'] = True
+        else:
+            d['csv'] = self.csv_path.data
         return d
 
 
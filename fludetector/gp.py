@@ -0,0 +1,134 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+
+
+Gaussian process models scored in Python, without Matlab or Octave.
+
+A model is exported (see fludetector/engines/fludetector_export_gp.m) to a
+JSON file named after its matlab_function, holding its training data and
+GPML-style hyperparameters (all in log space, as GPML keeps them):
+
+    {
+        "terms": ["flu", "cough", ...],   the columns of X
+        "X": [[...], ...],                training inputs, a row for each day
+        "y": [...],                       training targets
+        "mean": 0.0,                      a constant mean (optional)
+        "lik": -2.3,                      log of the noise standard deviation
+        "cov": [                          covariance functions, summed
+            {"type": "SEiso", "hyp": [log_ell, log_sf], "mask": [0, 1]},
+            {"type": "SEard", "hyp": [log_ell_1, ..., log_ell_d, log_sf]}
+        ]
+    }
+
+A covariance function's mask is the columns of X it applies to, all of them if
+it's left out. Terms a day has no average for are taken to be 0.
+"""
+import json
+import os
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.spatial.distance import cdist
+
+from fludetector.errors import FluDetectorError
+
+
+def squared_exponential(A, B, hyp, ard):
+    """GPML's covSEiso, or covSEard if ard, between the rows of A and B"""
+    d = A.shape[1]
+    if ard:
+        if len(hyp) != d + 1:
+            raise FluDetectorError('SEard over %d terms needs %d hyperparameters, not %d' % (d, d + 1, len(hyp)))
+        ell = np.exp(hyp[:d])
+    else:
+        if len(hyp) != 2:
+            raise FluDetectorError('SEiso needs 2 hyperparameters, not %d' % len(hyp))
+        ell = np.exp(hyp[0])
+    sf2 = np.exp(2 * hyp[-1])
+    return sf2 * np.exp(-cdist(A / ell, B / ell, 'sqeuclidean') / 2)
+
+
+COVARIANCES = {
+    'SEiso': lambda A, B, hyp: squared_exponential(A, B, hyp, False),
+    'SEard': lambda A, B, hyp: squared_exponential(A, B, hyp, True),
+}
+
+
+class GaussianProcess(object):
+    """A trained GP regression model, with its Cholesky factor worked out once
+    so that predicting is just a matrix product"""
+
+    def __init__(self, terms, X, y, cov, lik, mean=0.0):
+        self.terms = list(terms)
+        self.X = np.asarray(X, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.mean = float(mean)
+        self.cov = []
+        for c in cov:
+            if c['type'] not in COVARIANCES:
+                raise FluDetectorError('Unknown covariance function %s' % c['type'])
+            mask = c.get('mask')
+            mask = np.arange(len(self.terms)) if mask is None else np.asarray(mask, dtype=int)
+            self.cov.append((COVARIANCES[c['type']], mask, np.asarray(c['hyp'], dtype=float)))
+        if self.X.shape != (len(self.y), len(self.terms)):
+            raise FluDetectorError('Expected X to be %d x %d, not %s' % (
+                len(self.y), len(self.terms), 'x'.join(map(str, self.X.shape))))
+
+        K = self.covariance(self.X, self.X) + np.exp(2 * lik) * np.eye(len(self.y))
+        self.factor = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.factor, self.y - self.mean)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fh:
+            data = json.load(fh)
+        return cls(data['terms'], data['X'], data['y'], data['cov'], data['lik'], data.get('mean', 0.0))
+
+    def covariance(self, A, B):
+        return sum(k(A[:, mask], B[:, mask], hyp) for k, mask, hyp in self.cov)
+
+    def inputs(self, days_averages):
+        """The matrix of inputs for these days' averages, a row for each day"""
+        columns = dict((term, j) for j, term in enumerate(self.terms))
+        X = np.zeros((len(days_averages), len(self.terms)))
+        for i, averages in enumerate(days_averages):
+            for term, avg in averages:
+                if term in columns:
+                    X[i, columns[term]] = avg
+        return X
+
+    def predict(self, X):
+        """The predictive mean at each row of X"""
+        return self.mean + self.covariance(np.asarray(X, dtype=float), self.X).dot(self.alpha)
+
+
+class GaussianProcesses(object):
+    """Loads the exported models in a directory, keeping them once loaded"""
+
+    def __init__(self, path):
+        self.path = path
+        self.loaded = {}
+
+    def get(self, function):
+        if function not in self.loaded:
+            path = os.path.join(self.path, '%s.json' % function)
+            if not os.path.exists(path):
+                raise FluDetectorError('No exported model for %s at %s' % (function, path))
+            self.loaded[function] = GaussianProcess.load(path)
+        return self.loaded[function]
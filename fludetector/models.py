@@ -17,11 +17,31 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
-from datetime import timedelta
+from collections import defaultdict, namedtuple
+from datetime import date, timedelta
+from itertools import islice
 
+import numpy as np
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, bindparam, event, exists, func, text
+from sqlalchemy.pool import QueuePool
 
-db = SQLAlchemy()
+from fludetector.store import get_store, EPOCH
+
+
+class Database(SQLAlchemy):
+    """Lets SQLite file databases use a connection pool when
+    SQLALCHEMY_POOL_SIZE is set, SQLAlchemy gives them a NullPool otherwise"""
+
+    def apply_driver_hacks(self, app, info, options):
+        super(Database, self).apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite' and 'poolclass' not in options and options.get('pool_size'):
+            options['poolclass'] = QueuePool
+            # Pooled connections get handed to whichever thread asks next
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+
+db = Database()
 
 REGIONS = {
     'e': 'England',
@@ -36,6 +56,103 @@ def get_region(code):
     return {'code': code, 'name': REGIONS[code]}
 
 
+def smoothing_radius(days):
+    """How many days either side of a score a `days`-day moving average covers"""
+    return max(0, (days - 1) // 2)
+
+
+def centred_moving_averages(offsets, values, radius):
+    """Average every value with the values up to `radius` days either side of it.
+
+    offsets - Day offsets of the values from the first value, in ascending order
+    values - The values to average, one per offset
+    radius - How many days either side of each value to include
+
+    Days without a value are left out of the average rather than counted as
+    zero, which is what ModelScore.smoothed does. Uses cumulative sums so the
+    whole series is averaged in one pass.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if not len(offsets):
+        return np.zeros(0)
+    length = offsets[-1] + 1
+    totals = np.zeros(length + 1)
+    counts = np.zeros(length + 1)
+    totals[offsets + 1] = values
+    counts[offsets + 1] = 1
+    totals = np.cumsum(totals)
+    counts = np.cumsum(counts)
+    lower = np.clip(offsets - radius, 0, length)
+    upper = np.clip(offsets + radius + 1, 0, length)
+    return (totals[upper] - totals[lower]) / (counts[upper] - counts[lower])
+
+
+MeanScore = namedtuple('MeanScore', ['day', 'region', 'value', 'model'])
+
+StoredScore = namedtuple('StoredScore', ['day', 'region', 'value', 'model'])
+
+MEAN_PERIODS = {
+    # SQLite's 'weekday 0' modifier moves forward to the next Sunday, unless
+    # the day already is one, which is the end of the day's ISO week
+    'week_mean': lambda day: func.date(day, 'weekday 0', type_=db.Date),
+    'month_mean': lambda day: func.date(day, 'start of month', type_=db.Date),
+}
+
+RegionSummary = namedtuple('RegionSummary', ['first_day', 'last_day', 'count'])
+
+
+class ModelSummary(object):
+    """The regions, date span and number of stored ModelScores of a model
+
+    regions - A dict of region code to RegionSummary
+    """
+
+    def __init__(self):
+        self.regions = {}
+
+    @property
+    def region_codes(self):
+        return sorted(self.regions)
+
+    @property
+    def first_day(self):
+        return min([r.first_day for r in self.regions.values()] or [None])
+
+    @property
+    def last_day(self):
+        return max([r.last_day for r in self.regions.values()] or [None])
+
+    @property
+    def count(self):
+        return sum(r.count for r in self.regions.values())
+
+    def __repr__(self):
+        return '<ModelSummary %s>' % ', '.join(self.region_codes)
+
+
+def model_summary(models=None):
+    """Summarise the stored ModelScores of these models (or every model)
+
+    Uses a single aggregate query rather than loading any ModelScores.
+    Returns a dict of model ID to ModelSummary, models without any scores get
+    an empty ModelSummary.
+    """
+    query = db.session.query(
+        ModelScore.model_id,
+        ModelScore.region,
+        func.min(ModelScore.day),
+        func.max(ModelScore.day),
+        func.count()
+    ).group_by(ModelScore.model_id, ModelScore.region)
+    if models is not None:
+        query = query.filter(ModelScore.model_id.in_([m.id for m in models]))
+
+    summaries = defaultdict(ModelSummary)
+    for model_id, region, first_day, last_day, count in query:
+        summaries[model_id].regions[region] = RegionSummary(first_day, last_day, count)
+    return summaries
+
+
 class Model(db.Model):
     """The base class for storing model data.
 
@@ -51,11 +168,15 @@ class Model(db.Model):
     public = db.Column(db.Boolean, nullable=False)
     data = db.Column(db.Text, nullable=True)
 
+    @property
+    def summary(self):
+        """Returns a ModelSummary of this model's scores"""
+        return model_summary([self])[self.id]
+
     @property
     def regions(self):
         """Returns a list of the regions that this model has scores for"""
-        codes = set(s.region for s in self.scores)
-        return [get_region(c) for c in codes]
+        return [get_region(c) for c in self.summary.region_codes]
 
     @property
     def first_score(self):
@@ -79,18 +200,93 @@ class Model(db.Model):
         start - Only scores for this day onwards
         end - Only scores up to (not including) this day
         region - Only scores in this region
-        resolution - Default daily, if 'week' then only return scores from Sundays
+        resolution - Default daily, if 'week' then only return scores from Sundays.
+            If 'week_mean' or 'month_mean' then return a MeanScore per week
+            (Monday to Sunday, dated by the Sunday) or per calendar month
+            (dated by the 1st)
 
         """
+        if resolution in MEAN_PERIODS:
+            return self.get_mean_scores(start, end, region, resolution)
+
+        stored = self.get_stored_scores(start, end, region)
+        if stored is not None:
+            if resolution == 'week':
+                stored = [s for s in stored if s.day.weekday() == 6]
+            return stored
+
         scores = self.scores.filter(
             ModelScore.day >= start,
             ModelScore.day <= end,
-            ModelScore.region == region).all()
+            ModelScore.region == region)
 
         if resolution == 'week':
-            scores = [s for s in scores if s.day.weekday() == 6]
+            # SQLite's %w is the day of the week with Sunday as 0
+            scores = scores.filter(func.strftime('%w', ModelScore.day) == '0')
 
-        return scores
+        return scores.all()
+
+    def get_mean_scores(self, start, end, region, resolution):
+        """Average the ModelScores that match the arguments by week or month,
+        see get_scores. The averaging is done by the database."""
+        period = MEAN_PERIODS[resolution](ModelScore.day).label('period')
+        means = db.session.query(period, func.avg(ModelScore.value)).filter(
+            ModelScore.model_id == self.id,
+            ModelScore.day >= start,
+            ModelScore.day <= end,
+            ModelScore.region == region).group_by(period).order_by(period)
+        return [MeanScore(day, region, value, self) for day, value in means]
+
+    def get_stored_scores(self, start, end, region):
+        """Read this region's scores between start and end (inclusive) from the
+        ScoreStore instead of the database
+
+        Returns a list of StoredScores, or None if there's no ScoreStore or it
+        doesn't have this series yet.
+        """
+        store = get_store()
+        if store is None:
+            return None
+        series = store.read(self.id, region, start, end)
+        if series is None:
+            return None
+        days, values = series
+        return [StoredScore(day, region, float(value), self) for day, value in zip(days, values)]
+
+    def get_smoothed_scores(self, start, end, region, resolution, smoothing):
+        """Like get_scores, but returns (ModelScore, smoothed value) pairs
+
+        smoothing - The number of days to average each score over, centred on
+            its day, same as ModelScore.smoothed
+
+        All the scores needed for the averages are loaded in a single query
+        instead of one query per score.
+        """
+        radius = smoothing_radius(smoothing)
+        if not radius or resolution in MEAN_PERIODS:
+            # Means are already smoothed over their week or month
+            return [(s, s.value) for s in self.get_scores(start, end, region, resolution)]
+
+        padding = timedelta(days=radius)
+        scores = self.get_stored_scores(start - padding, end + padding, region)
+        if scores is None:
+            scores = self.scores.filter(
+                ModelScore.day >= start - padding,
+                ModelScore.day <= end + padding,
+                ModelScore.region == region).order_by(ModelScore.day.asc()).all()
+        if not scores:
+            return []
+
+        first_day = scores[0].day
+        smoothed = centred_moving_averages(
+            [(s.day - first_day).days for s in scores],
+            [s.value for s in scores],
+            radius)
+
+        return [
+            (s, float(value))
+            for s, value in zip(scores, smoothed)
+            if start <= s.day <= end and (resolution != 'week' or s.day.weekday() == 6)]
 
     def get_data(self):
         """Parse this model's data attribute and return a dict"""
@@ -125,6 +321,10 @@ class Model(db.Model):
 
 class ModelScore(db.Model):
     """Represents a fully analysed score for a model in a single region on a single day"""
+    __table_args__ = (
+        db.Index('ix_model_score_model_id_region_day', 'model_id', 'region', 'day'),
+    )
+
     day = db.Column(db.Date, primary_key=True, nullable=False)
     region = db.Column(db.Text, primary_key=True, nullable=False)
     value = db.Column(db.Float, nullable=False)
@@ -148,6 +348,77 @@ class ModelScore(db.Model):
             self.day.strftime('%Y-%m-%d'), self.region, self.value)
 
 
+class ModelRun(db.Model):
+    """A run of a model over a range of days, committed in chunks
+
+    completed - The last day of the last chunk that was committed, runs that
+        fail can be resumed from the day after it
+    status - running, failed or complete
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    start = db.Column(db.Date, nullable=False)
+    end = db.Column(db.Date, nullable=False)
+    completed = db.Column(db.Date, nullable=True)
+    status = db.Column(db.Text, nullable=False)
+    started = db.Column(db.DateTime, nullable=False)
+    updated = db.Column(db.DateTime, nullable=False)
+
+    model_id = db.Column(db.Integer, db.ForeignKey('model.id'), nullable=False)
+    model = db.relationship(
+        'Model',
+        backref=db.backref('runs', lazy='dynamic', cascade='all,delete,delete-orphan'))
+
+    @property
+    def resume_from(self):
+        """The first day that hasn't been committed yet"""
+        if self.completed is None:
+            return self.start
+        return self.completed + timedelta(days=1)
+
+    def __repr__(self):
+        return '<ModelRun %d %s %s-%s>' % (self.id, self.status, self.start, self.end)
+
+
+class CsvImport(db.Model):
+    """A CSV file imported into a model, so unchanged files can be skipped
+
+    sha256 - The hash of the file's contents
+    start, end - The days that were imported from it
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.Text, index=True, nullable=False)
+    filename = db.Column(db.Text, nullable=False)
+    start = db.Column(db.Date, nullable=False)
+    end = db.Column(db.Date, nullable=False)
+    imported = db.Column(db.DateTime, nullable=False)
+    rows = db.Column(db.Integer, nullable=False)
+
+    model_id = db.Column(db.Integer, db.ForeignKey('model.id'), nullable=False)
+    model = db.relationship(
+        'Model',
+        backref=db.backref('csv_imports', lazy='dynamic', cascade='all,delete,delete-orphan'))
+
+    def __repr__(self):
+        return '<CsvImport %s %s %s-%s>' % (self.filename, self.sha256[:8], self.start, self.end)
+
+
+class CachedModelScore(db.Model):
+    """A value calculated by a model function, kept so the same inputs aren't
+    calculated again (see fludetector.cache.ScoreCache)
+
+    key - A hash of the function, SCORE_CACHE_VERSION and averages
+    used - When it was last calculated or looked up, the least recently used
+        are evicted first
+    """
+    key = db.Column(db.Text, primary_key=True, nullable=False)
+    function = db.Column(db.Text, index=True, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    used = db.Column(db.DateTime, index=True, nullable=False)
+
+    def __repr__(self):
+        return '<CachedModelScore %s %s %f>' % (self.function, self.key[:8], self.value)
+
+
 model_google_terms = db.Table(
     'model_google_terms',
     db.Column('model_id', db.Integer, db.ForeignKey('model.id'), nullable=False),
@@ -171,6 +442,10 @@ class GoogleTerm(db.Model):
 
 class GoogleScore(db.Model):
     """A raw score from Google for a GoogleTerm on a single day"""
+    __table_args__ = (
+        db.Index('ix_google_score_term_id_day', 'term_id', 'day'),
+    )
+
     day = db.Column(db.Date, primary_key=True, nullable=False)
     value = db.Column(db.Float, nullable=False)
 
@@ -184,14 +459,26 @@ class GoogleScore(db.Model):
             self.day.strftime('%Y-%m-%d'), self.value)
 
 
-class GoogleLog(db.Model):
-    """Timestamp information for scores downloaded from Google"""
+class GoogleFetch(db.Model):
+    """An audit record of one call to Google for a batch of GoogleScores
+
+    Records migrated from the old per-score google_log table only have the
+    date range, timestamp and row count.
+    """
     id = db.Column(db.Integer, primary_key=True)
-    score_timestamp = db.Column(db.DateTime, nullable=False)
-    score_date = db.Column(db.Date, nullable=False)
+    batch_id = db.Column(db.Text)
+    terms_hash = db.Column(db.Text)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.Integer)
+    latency = db.Column(db.Float)
+    retries = db.Column(db.Integer)
+    row_count = db.Column(db.Integer, nullable=False)
 
     def __repr__(self):
-        return '<GoogleLog %s %s>' % (self.score_timestamp, self.score_date)
+        return '<GoogleFetch %s %s %s-%s %s>' % (
+            self.batch_id, self.timestamp, self.start_date, self.end_date, self.status)
 
 
 model_twitter_ngrams = db.Table(
@@ -218,6 +505,10 @@ class TwitterNgram(db.Model):
 
 class TwitterScore(db.Model):
     """The raw score from Twitter for a single NGram on a single day"""
+    __table_args__ = (
+        db.Index('ix_twitter_score_ngram_id_day', 'ngram_id', 'day'),
+    )
+
     day = db.Column(db.Date, primary_key=True, nullable=False)
     value = db.Column(db.Float, nullable=False)
 
@@ -231,7 +522,149 @@ class TwitterScore(db.Model):
             self.day.strftime('%Y-%m-%d'), self.value)
 
 
+def calendar(start, end):
+    """A subquery with a row for every day between start and end (inclusive)
+
+    It's generated by a recursive CTE nested inside the subquery, so the
+    statements using it still start with SELECT. Python 2's sqlite3 loses the
+    columns of empty results from statements that start with WITH.
+    """
+    return text(
+        "WITH RECURSIVE calendar(day) AS ("
+        "SELECT date(:start) UNION ALL "
+        "SELECT date(day, '+1 day') FROM calendar WHERE day < date(:end)) "
+        "SELECT day FROM calendar WHERE day <= date(:end)"
+    ).bindparams(
+        bindparam('start', start, type_=db.Date),
+        bindparam('end', end, type_=db.Date)
+    ).columns(day=db.Date).alias('calendar')
+
+
+def missing_scores(keys, score_key, score_day, start, end, *criteria):
+    """Find what's missing a score between start and end (inclusive)
+
+    keys - A query with a single column labelled 'key', e.g. a model's term ids
+    score_key, score_day - The score table's columns to match the keys and days on
+    criteria - Any more filters on the score table, e.g. the region
+
+    Anti-joins a calendar of just the requested days against the score table,
+    so it only looks at the requested range however much history there is.
+    Returns a query of (key, day) pairs, ordered by key then day.
+    """
+    keys = keys.subquery()
+    days = calendar(start, end)
+    scored = exists().where(and_(score_key == keys.c.key, score_day == days.c.day, *criteria))
+    return db.session.query(keys.c.key, days.c.day).filter(~scored).order_by(keys.c.key, days.c.day)
+
+
+def bulk_upsert(model_class, rows, chunk_size=500):
+    """Write rows into model_class's table, replacing any existing rows with
+    the same primary key.
+
+    rows - An iterable of dicts of column name to value, e.g.
+        {'term_id': 1, 'day': date(2018, 1, 1), 'value': 2.0}
+
+    Rows are written chunk_size at a time with executemany, rather than
+    querying for and adding an ORM object per row. It goes through the
+    session so it's part of the same transaction, remember to commit.
+    Returns the number of rows written.
+    """
+    statement = model_class.__table__.insert().prefix_with('OR REPLACE')
+    rows = iter(rows)
+    count = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return count
+        db.session.execute(statement, chunk)
+        count += len(chunk)
+
+
+def refresh_score_store(model, start=None, end=None):
+    """Copy this model's ModelScores between start and end (inclusive, all of
+    them by default) into the ScoreStore, if there is one.
+
+    Call this after committing new ModelScores, or deleting some. Stored days
+    in the range without a ModelScore are marked as missing. The store treats
+    a series as complete, so a region's first copy is of all its ModelScores.
+    """
+    store = get_store()
+    if store is None:
+        return
+    stored = store.regions(model.id)
+    regions = set(region for region, in db.session.query(ModelScore.region).filter(
+        ModelScore.model_id == model.id).distinct())
+    for region in regions | stored:
+        if region in stored:
+            region_start, region_end = start or EPOCH, end or date.max
+        else:
+            region_start, region_end = EPOCH, date.max
+        scores = db.session.query(ModelScore.day, ModelScore.value).filter(
+            ModelScore.model_id == model.id,
+            ModelScore.region == region,
+            ModelScore.day >= region_start,
+            ModelScore.day <= region_end)
+        days, values = [], []
+        for day, value in scores:
+            days.append(day)
+            values.append(value)
+        store.write(model.id, region, days, values, region_start, region_end)
+
+
+def rebuild_score_store(model):
+    """Throw away this model's series in the ScoreStore and copy them again"""
+    store = get_store()
+    if store is None:
+        return
+    store.remove(model.id)
+    refresh_score_store(model)
+
+
+# (PRAGMA, config key, default) set on every new SQLite connection. WAL lets
+# the website's workers keep reading while a model run is writing, and the
+# busy timeout (in milliseconds) makes writers queue up instead of failing
+SQLITE_PRAGMAS = [
+    ('busy_timeout', 'SQLITE_BUSY_TIMEOUT', 30000),
+    ('journal_mode', 'SQLITE_JOURNAL_MODE', 'WAL'),
+    ('synchronous', 'SQLITE_SYNCHRONOUS', 'NORMAL'),
+    ('mmap_size', 'SQLITE_MMAP_SIZE', 268435456),
+    ('cache_size', 'SQLITE_CACHE_SIZE', -65536),
+]
+
+POOL_CONFIG = [
+    'SQLALCHEMY_POOL_SIZE',
+    'SQLALCHEMY_POOL_TIMEOUT',
+    'SQLALCHEMY_POOL_RECYCLE',
+    'SQLALCHEMY_MAX_OVERFLOW',
+]
+
+
+def set_sqlite_pragmas(config):
+    """Returns a connect event listener that sets the SQLITE_PRAGMAS"""
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, key, default in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA %s = %s' % (pragma, config.get(key, default)))
+        cursor.close()
+    return on_connect
+
+
 def init_app(app):
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../data.db'
+    """Set up the database for this app.
+
+    The database defaults to data.db in the project's root, set
+    SQLALCHEMY_DATABASE_URI to use another one. The pool can be configured
+    with the usual Flask-SQLAlchemy settings (see POOL_CONFIG), and the
+    SQLite connections with those in SQLITE_PRAGMAS.
+    """
+    app.config.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///../data.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    for key in POOL_CONFIG:
+        # Settings from the .env file are strings
+        if app.config.get(key) is not None:
+            app.config[key] = int(app.config[key])
     db.init_app(app)
+
+    engine = db.get_engine(app)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', set_sqlite_pragmas(app.config))
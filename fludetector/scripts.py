@@ -17,14 +17,18 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
+import json
+import shutil
 from datetime import datetime, date, timedelta
 
 import click
+from flask import current_app
 from sqlalchemy.orm.exc import NoResultFound
 
 from fludetector.sources import google, csv_, twitter
+from fludetector.cache import clear_scores
 from fludetector.errors import FluDetectorError
-from fludetector.models import db, Model
+from fludetector.models import db, rebuild_score_store, Model, ModelRun
 
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
@@ -52,19 +56,66 @@ def listmodels():
         click.echo('%d) %s (%s)' % (m.id, m.name, 'Public' if m.public else 'Private'))
 
 
+@click.argument('model_ids', type=int, nargs=-1)
+def buildstore(model_ids):
+    """Rebuild the score store (all models by default)"""
+    if not current_app.config.get('SCORE_STORE_PATH'):
+        raise click.ClickException('SCORE_STORE_PATH is not configured')
+    models = Model.query
+    if model_ids:
+        models = models.filter(Model.id.in_(model_ids))
+    for m in models:
+        click.echo('Rebuilding %s' % m.name)
+        rebuild_score_store(m)
+
+
+@click.argument('model_ids', type=int, nargs=-1, required=True)
+def clearscorecache(model_ids):
+    """Forget the cached values of these models' functions"""
+    for m in Model.query.filter(Model.id.in_(model_ids)):
+        if m.type not in ('google', 'twitter'):
+            continue
+        function = m.get_data()['matlab_function']
+        click.echo('Cleared %d cached values of %s for %s' % (clear_scores(function), function, m.name))
+    db.session.commit()
+
+
+def next_day_to_run(model):
+    """Return the day after the model's latest score"""
+    last_day = model.summary.last_day
+    if last_day is None:
+        raise click.ClickException('%s has no scores yet, so the day to start from is needed' % model.name)
+    return last_day + timedelta(days=1)
+
+
 @click.argument('model_id', type=int)
 @click.option('-s', '--start', help='Collect data from (including) this day (YYYY-MM-DD) (defaults to the day after the most recent score)')
 @click.option('-e', '--end', help='Collect data up to (not including) this day (YYYY-MM-DD) (defaults to 2 days ago)')
-@click.option('--csv', help='The CSV file with data to analyse (used for CSV-type models)', type=click.File('rb'))
-def runmodel(model_id, start, end, csv):
+@click.option('--csv', help='The CSV file with data to analyse, or a directory or glob of them, or - to read standard input (used for CSV-type models)')
+@click.option('--cleanup', is_flag=True, help='Delete the --csv directory once the run is over (used for uploads)')
+@click.option('--replay', is_flag=True, help='Only use cached responses, never query Google (used for Google-type models)')
+@click.option('--plan', is_flag=True, help='Print the calls to Google that would be made, without making them (used for Google-type models)')
+@click.option('--resume', type=int, help='Carry on a failed run from its last checkpoint, instead of using --start and --end (used for Google-type models)')
+def runmodel(model_id, start, end, csv, replay, plan, resume, cleanup):
     """Collect data and run model over them"""
     try:
         model = Model.query.filter_by(id=model_id).one()
 
+        if resume:
+            model_run = ModelRun.query.filter_by(id=resume, model_id=model.id).first()
+            if model.type != 'google':
+                raise click.ClickException('Only Google-type models can be resumed')
+            if model_run is None:
+                raise click.ClickException('Could not find a run of this model with that ID')
+            if model_run.status == 'complete':
+                raise click.ClickException('That run has already completed')
+            MODEL_TYPES[model.type].run(model, model_run.start, model_run.end, replay=replay, resume=model_run)
+            return
+
         if start:
             start = datetime.strptime(start, '%Y-%m-%d').date()
         else:
-            start = model.last_score.day + timedelta(days=1)
+            start = next_day_to_run(model)
 
         if end:
             end = datetime.strptime(end, '%Y-%m-%d').date()
@@ -76,19 +127,91 @@ def runmodel(model_id, start, end, csv):
         if end >= date.today():
             raise click.ClickException('End must be in the past')
 
-        MODEL_TYPES[model.type].run(model, start, end, csv_file=csv)
+        if plan:
+            printplan(model, start, end)
+        else:
+            csv_file = click.get_binary_stream('stdin') if csv == '-' else csv
+            MODEL_TYPES[model.type].run(model, start, end, csv_file=csv_file, replay=replay)
     except NoResultFound:
         raise click.ClickException('Could not find model with that ID')
     except FluDetectorError as e:
         raise click.ClickException(e.message)
+    finally:
+        if cleanup and csv and csv != '-':
+            shutil.rmtree(csv, ignore_errors=True)
+
+
+def listruns():
+    """List the runs of models that haven't completed"""
+    for r in ModelRun.query.filter(ModelRun.status != 'complete').order_by(ModelRun.id):
+        click.echo('%d) %s %s to %s, %s, done up to %s' % (
+            r.id, r.model.name, r.start, r.end, r.status, r.completed or '-'))
+
+
+def printplan(model, start, end):
+    if model.type != 'google':
+        raise click.ClickException('Only Google-type models can be planned')
+    calls = google.plan(model, start, end)
+    for terms, s, e in calls:
+        click.echo('%s to %s, %d terms (%d points): %s' % (
+            s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d'), len(terms),
+            len(terms) * ((e - s).days + 1), ', '.join(t.term for t in terms)))
+    click.echo('%d calls' % len(calls))
+
+
+@click.option('-t', '--terms', default=100, help='The number of synthetic terms (default 100)')
+@click.option('-d', '--days', default=365, help='The number of days to run over (default 365)')
+@click.option('--latency', default=0.2, help='Seconds the fake API takes to answer (default 0.2)')
+@click.option('--error-rate', default=0.0, help='The fraction of fake API calls that fail (default 0)')
+@click.option('--padding', default=0, help='Extra characters in each point of the fake responses (default 0)')
+@click.option('--workers', default=4, help='Concurrent calls to the fake API (default 4)')
+@click.option('--json', 'as_json', is_flag=True, help='Print the results as JSON')
+def benchmark(terms, days, latency, error_rate, padding, workers, as_json):
+    """Time each stage of running a Google model against a fake API"""
+    from fludetector.benchmark import run_benchmark
+    results = run_benchmark(terms, days, latency, error_rate, padding, workers)
+    if as_json:
+        click.echo(json.dumps(results, indent=2))
+        return
+    click.echo('%d terms x %d days' % (terms, days))
+    for stage, result in results.iteritems():
+        click.echo('%-12s %8.3fs %6d queries %6d requests' % (
+            stage, result['seconds'], result['queries'], result['requests']))
+    click.echo('%-12s %8.3fs' % ('total', sum(r['seconds'] for r in results.itervalues())))
+
+
+@click.option('--engine', type=click.Choice(['matlab', 'octave', 'native', 'fake']), default='octave', help='The engine to calculate scores with')
+@click.option('-w', '--workers', type=int, help='Engine processes to run (defaults to CALCULATOR_WORKERS)')
+@click.option('--socket', 'path', help='The Unix socket to listen on (defaults to CALCULATOR_SOCKET)')
+def runcalculator(engine, workers, path):
+    """Run a calculator daemon, for models run with MODEL_ENGINE=remote"""
+    from fludetector.calculator import calculator_socket, calculator_workers
+    from fludetector.daemon import build_engine, CalculatorDaemon
+    path = path or calculator_socket()
+    try:
+        daemon = CalculatorDaemon(path, build_engine(engine), workers or calculator_workers())
+    except FluDetectorError as e:
+        raise click.ClickException(e.message)
+    click.echo('Calculating with %s on %s' % (engine, path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
 
 
 def init_app(app):
     command = app.cli.command()
     command(initdb)
     command(listmodels)
+    command(buildstore)
+    command(clearscorecache)
     command(runmodel)
+    command(listruns)
     command(runmodelscheduler)
+    command(benchmark)
+    command(runcalculator)
 
 
 def runmodel_func(model_id):
@@ -96,7 +219,7 @@ def runmodel_func(model_id):
     with app.app_context():
         try:
             model = Model.query.filter_by(id=model_id).one()
-            start = model.last_score.day + timedelta(days=1)
+            start = next_day_to_run(model)
             end = date.today() - timedelta(days=2)
             MODEL_TYPES[model.type].run(model, start, end, csv_file=None)
         except NoResultFound:
@@ -18,13 +18,22 @@ You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
 import csv
+import glob
+import hashlib
+import multiprocessing
+import os
+import Queue
+import time
+from collections import defaultdict
 from datetime import datetime
-
-from sqlalchemy.orm.exc import NoResultFound
+from itertools import islice
 
 from fludetector.log import logger
 from fludetector.errors import FluDetectorError
-from fludetector.models import db, REGIONS, ModelScore
+from fludetector.models import db, bulk_upsert, refresh_score_store, REGIONS, CsvImport, ModelScore
+
+# The number of scores imported and committed at a time
+CHUNK_SIZE = 5000
 
 
 def find_matching_index(headers, possible, required=False):
@@ -50,10 +59,9 @@ def find_region_index(headers):
     return indexes
 
 
-def run(model, start, end, csv_file=None, **kwargs):
-    if csv_file is None:
-        raise FluDetectorError('No CSV file provided')
-    logger.info('Reading CSV file into %s' % str(model))
+def read_scores(model_id, csv_file, start, end, stats):
+    """Yield a ModelScore row for each cell of the CSV file between start and
+    end, counting the rows read and the cells skipped in stats"""
     csv_reader = csv.reader(csv_file)
 
     headers = next(csv_reader)
@@ -63,8 +71,8 @@ def run(model, start, end, csv_file=None, **kwargs):
 
     logger.debug('Found columns for regions %s' % ', '.join(region_index.keys()))
 
-    logger.info('Reading rows...')
     for row_index, row in enumerate(csv_reader):
+        stats['rows'] += 1
         day = datetime.strptime(row[day_index], '%Y-%m-%d').date()
 
         if day < start or day > end:
@@ -75,16 +83,192 @@ def run(model, start, end, csv_file=None, **kwargs):
                 value = float(row[col_index])
             except ValueError:
                 logger.debug('Skipping row %d column %d, not a float' % (row_index + 1, col_index))
+                stats['skipped'] += 1
+                continue
+            yield {'model_id': model_id, 'day': day, 'region': region, 'value': value}
+
+
+def existing_keys(model_id, chunk):
+    """Return the (day, region) of the model's ModelScores over the days of
+    this chunk of scores"""
+    days = [score['day'] for score in chunk]
+    return set(db.session.query(ModelScore.day, ModelScore.region).filter(
+        ModelScore.model_id == model_id, ModelScore.day >= min(days), ModelScore.day <= max(days)))
+
+
+def write_scores(model_id, scores, stats, chunk_size):
+    """Write the scores chunk_size at a time, committing each chunk, and count
+    how many were added and replaced"""
+    while True:
+        chunk = list(islice(scores, chunk_size))
+        if not chunk:
+            return
+        existing = existing_keys(model_id, chunk)
+        bulk_upsert(ModelScore, chunk, chunk_size)
+        db.session.commit()
+        for score in chunk:
+            key = (score['day'], score['region'])
+            if key in existing:
+                stats['replaced'] += 1
+            else:
+                stats['added'] += 1
+                existing.add(key)
+
+
+def csv_files(path):
+    """Return the CSV files path refers to, it can be a file, a directory of
+    .csv files or a glob"""
+    if os.path.isdir(path):
+        paths = glob.glob(os.path.join(path, '*.csv'))
+    elif os.path.isfile(path):
+        paths = [path]
+    else:
+        paths = glob.glob(path)
+    if not paths:
+        raise FluDetectorError('No CSV files found at %s' % path)
+    return sorted(paths)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_file(path, model_id, start, end, stats):
+    """Like read_scores, for the CSV file at path"""
+    with open(path, 'rb') as fh:
+        for score in read_scores(model_id, fh, start, end, stats):
+            yield score
+
+
+def parse_file(path, model_id, start, end, chunk_size, results):
+    """Put the scores in a CSV file on the results queue chunk_size at a time,
+    followed by the file's stats, run in the import workers"""
+    try:
+        stats = defaultdict(int)
+        scores = read_file(path, model_id, start, end, stats)
+        for chunk in iter(lambda: list(islice(scores, chunk_size)), []):
+            results.put(chunk)
+        results.put(dict(stats))
+    except Exception as e:
+        results.put(FluDetectorError('Could not read %s: %s' % (path, e)))
+
+
+def parsed_scores(process, results, stats):
+    """Yield the scores a parse_file process puts on results, adding the
+    file's stats to stats"""
+    while True:
+        try:
+            item = results.get(timeout=1)
+        except Queue.Empty:
+            if process.is_alive():
                 continue
+            # It may have finished between the get and the check
             try:
-                ms = ModelScore.query.filter_by(model_id=model.id, day=day, region=region).one()
-            except NoResultFound:
-                ms = ModelScore()
-                ms.region = region
-                ms.model = model
-                ms.day = day
-            ms.value = value
-            db.session.add(ms)
-
-    db.session.commit()
-    logger.info('Done!')
+                item = results.get(timeout=1)
+            except Queue.Empty:
+                raise FluDetectorError('CSV import worker %d died' % process.pid)
+        if isinstance(item, Exception):
+            raise item
+        if isinstance(item, dict):
+            for key, value in item.iteritems():
+                stats[key] += value
+            return
+        for score in item:
+            yield score
+
+
+def import_workers():
+    """Return the number of processes to parse CSV files in"""
+    return int(os.environ.get('CSV_IMPORT_WORKERS', multiprocessing.cpu_count()))
+
+
+def import_files(model, start, end, paths, stats, chunk_size):
+    """Import many CSV files, parsing them in parallel and writing them here
+    in order, so where files overlap the last one wins. Files already imported
+    into the model, over at least these days, are skipped, unless a file
+    before them is being imported (it might overwrite some of their scores).
+
+    Each file is parsed in a process of its own, up to CSV_IMPORT_WORKERS at
+    a time, which hands its scores over chunk_size at a time through a short
+    queue. So no more than a few chunks of each file are held in memory while
+    the files before it are written.
+    """
+    hashes = dict((path, file_hash(path)) for path in paths)
+    imported = set(sha256 for sha256, in db.session.query(CsvImport.sha256).filter(
+        CsvImport.model_id == model.id, CsvImport.sha256.in_(set(hashes.values())),
+        CsvImport.start <= start, CsvImport.end >= end))
+    changed = [i for i, path in enumerate(paths) if hashes[path] not in imported]
+    todo = paths[changed[0]:] if changed else []
+    stats['files'] += len(todo)
+    stats['unchanged_files'] += len(paths) - len(todo)
+    for path in paths:
+        if path not in todo:
+            logger.info('Skipping %s, it has already been imported' % path)
+
+    workers = import_workers()
+    parsers = []
+    try:
+        for i, path in enumerate(todo):
+            file_stats = defaultdict(int)
+            if len(todo) == 1:
+                scores = read_file(path, model.id, start, end, file_stats)
+            else:
+                while len(parsers) < min(len(todo), i + workers):
+                    results = multiprocessing.Queue(2)
+                    process = multiprocessing.Process(
+                        target=parse_file, args=(todo[len(parsers)], model.id, start, end, chunk_size, results))
+                    process.daemon = True
+                    process.start()
+                    parsers.append((process, results))
+                scores = parsed_scores(parsers[i][0], parsers[i][1], file_stats)
+            logger.info('Writing scores from %s' % path)
+            write_scores(model.id, scores, stats, chunk_size)
+            for key, value in file_stats.iteritems():
+                stats[key] += value
+            db.session.add(CsvImport(
+                model=model, sha256=hashes[path], filename=os.path.basename(path),
+                start=start, end=end, imported=datetime.utcnow(), rows=file_stats['rows']))
+            db.session.commit()
+    finally:
+        for process, results in parsers:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def run(model, start, end, csv_file=None, chunk_size=CHUNK_SIZE, **kwargs):
+    """Import the scores between start and end, chunk_size rows at a time,
+    committing each chunk. Returns a dict of how many rows were read, cells
+    skipped, and scores added and replaced.
+
+    csv_file - A file object to read, or the path of a file, a directory of
+        files or a glob of them (see import_files)
+    """
+    if csv_file is None:
+        raise FluDetectorError('No CSV file provided')
+    logger.info('Reading CSV into %s' % str(model))
+
+    stats = defaultdict(int, rows=0, skipped=0, added=0, replaced=0)
+    began = time.time()
+
+    logger.info('Reading rows...')
+    try:
+        if isinstance(csv_file, basestring):
+            import_files(model, start, end, csv_files(csv_file), stats, chunk_size)
+        else:
+            write_scores(model.id, read_scores(model.id, csv_file, start, end, stats), stats, chunk_size)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        # Chunks committed before a failure are still copied to the store
+        refresh_score_store(model, start, end)
+    seconds = time.time() - began
+    logger.info('Done! Read %d rows in %.1fs (%.0f a second), added %d scores, replaced %d, skipped %d cells' % (
+        stats['rows'], seconds, stats['rows'] / seconds if seconds else 0,
+        stats['added'], stats['replaced'], stats['skipped']))
+    return dict(stats)
@@ -17,96 +17,137 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
-import tempfile
+import _strptime  # noqa, strptime's lazy import isn't thread safe in Python 2
+import hashlib
+import json
+import threading
+import uuid
+import Queue
 import time
 import os
 import logging
+import random
+from collections import defaultdict, deque, namedtuple
 from datetime import datetime, timedelta
+from itertools import groupby
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-from sqlalchemy.orm.exc import NoResultFound
-from apiclient.discovery import build
+import httplib2
+import numpy as np
+from apiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
-from sh import ssh, scp, ErrorReturnCode
+from sh import ErrorReturnCode
 
 from stompest.sync.client import Stomp
 from stompest.config import StompConfig
 from stompest.protocol import StompSpec
 
+from fludetector.cache import get_response_cache, get_score_cache, request_key, score_key
+from fludetector.errors import FluDetectorError
 from fludetector.log import logger
-from fludetector.models import db, GoogleScore, ModelScore, GoogleLog
+from fludetector.models import (
+    db, bulk_upsert, missing_scores, model_google_terms, refresh_score_store,
+    GoogleFetch, GoogleScore, Model, ModelRun, ModelScore)
 
-from fludetector.calculator import buildCalculator, CalculatorType
+from fludetector.calculator import buildCalculator, buildCalculatorPool, calculator_workers, CalculatorType
 
+# A batch's terms as plain values, so the fetch threads never touch the session
+SearchTerm = namedtuple('SearchTerm', ['id', 'term'])
 
-def get_google_score(term, day):
-    try:
-        gs = GoogleScore.query.filter_by(term_id=term.id, day=day).one()
-    except NoResultFound:
-        gs = GoogleScore()
-        gs.day = day
-        gs.term = term
-    return gs
+GEO_REGION = 'GB-ENG'
+DISCOVERY_DOCUMENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trends_v1beta.json')
+MAX_TERMS = 30
+MAX_POINTS = 2000
+MAX_ATTEMPTS = 5
+BACKOFF = 3
 
 
-def collect_google_scores(terms, start, end):
+def build_service():
+    """Build a Trends API client from the bundled discovery document
+
+    The client has its own httplib2 session, which keeps its connection to
+    Google alive between requests and asks for gzipped responses. Set
+    GOOGLE_API_ROOT to send the requests somewhere else, e.g. the fake API in
+    fludetector.benchmark.
+    """
     logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
-    logger.info('Querying %d terms between %s and %s' % (len(terms), start, end))
-    logger.debug(', '.join(t.term for t in terms))
-    service = build(
-        'trends',
-        'v1beta',
-        developerKey=os.environ["GOOGLE_API_KEY"],
-        discoveryServiceUrl='https://www.googleapis.com/discovery/v1/apis/trends/v1beta/rest',
-        cache_discovery=False
-    )
-    graph = service.getTimelinesForHealth(
-        terms=[t.term for t in terms],
-        geoRestriction_region='GB-ENG',
-        time_startDate=start.strftime('%Y-%m-%d'),
-        time_endDate=end.strftime("%Y-%m-%d"),
-        timelineResolution='day')
-    try:
-        response = graph.execute()
-    except HttpError as e:
-        logger.exception(e)
-        raise e
-    for line in response['lines']:
-        term = next(t for t in terms if t.term == line['term'])
-        for point in line['points']:
-            day = datetime.strptime(point['date'], "%b %d %Y").date()
-            gs = get_google_score(term, day)
-            gs.value = float(point['value'])
-            yield gs
+    with open(DISCOVERY_DOCUMENT) as fd:
+        document = json.load(fd)
+    if os.environ.get('GOOGLE_API_ROOT'):
+        document['rootUrl'] = os.environ['GOOGLE_API_ROOT']
+    return build_from_document(document, http=httplib2.Http(), developerKey=os.environ["GOOGLE_API_KEY"])
 
 
-def send_to_matlab(model, averages):
-    fd = tempfile.NamedTemporaryFile()
-    fd.write('\n'.join('%s,%f' % a for a in averages))
-    fd.flush()
+class ServicePool(object):
+    """Trends API clients shared by the whole process
 
-    logger.debug('Sending query list and GoogleScores to fmedia13')
-    scp(fd.name, 'fmedia13:/tmp/fludetector_google_matlab_input')
-    fd.close()
+    httplib2 sessions aren't thread safe, so each client is only lent to one
+    thread at a time. Clients are built as needed and kept for later runs.
+    """
+
+    def __init__(self):
+        self.idle = Queue.LifoQueue()
+
+    @contextmanager
+    def service(self):
+        try:
+            service = self.idle.get_nowait()
+        except Queue.Empty:
+            service = build_service()
+        try:
+            yield service
+        finally:
+            self.idle.put(service)
 
-    fmedia13 = ssh.bake('fmedia13')
+    def close(self):
+        """Close the idle clients' connections, and forget them"""
+        while True:
+            try:
+                service = self.idle.get_nowait()
+            except Queue.Empty:
+                return
+            for connection in service._http.connections.values():
+                connection.close()
 
-    run = ';'.join([
-        "fin='/tmp/fludetector_google_matlab_input'",
-        "fout='/tmp/fludetector_google_matlab_output'",
-        "cd /home/vlampos/website_v2",
-        "run('gpml/startup.m')",
-        "%s(fin,fout)" % model.get_data()['matlab_function'],
-        "exit"])
-    logger.debug('Running matlab function over scores')
-    fmedia13('matlab', '-nodisplay', '-nojvm', '-r', '"%s"' % run)
 
-    logger.debug('Reading matlab results back')
-    value = float(fmedia13('cat', '/tmp/fludetector_google_matlab_output').strip())
+services = ServicePool()
 
-    logger.debug('Cleaning up temp files')
-    fmedia13('rm', '/tmp/fludetector_google_matlab_input', '/tmp/fludetector_google_matlab_output')
 
-    return value
+def query_google(terms, start, end):
+    """Return Google's raw response for these terms between start and end"""
+    logger.info('Querying %d terms between %s and %s' % (len(terms), start, end))
+    logger.debug(', '.join(t.term for t in terms))
+    began = time.time()
+    with services.service() as service:
+        graph = service.getTimelinesForHealth(
+            terms=[t.term for t in terms],
+            geoRestriction_region=GEO_REGION,
+            time_startDate=start.strftime('%Y-%m-%d'),
+            time_endDate=end.strftime("%Y-%m-%d"),
+            timelineResolution='day')
+        try:
+            response = graph.execute()
+        except HttpError as e:
+            logger.exception(e)
+            raise e
+    logger.info('Queried %d terms between %s and %s in %.2f seconds' % (len(terms), start, end, time.time() - began))
+    return response
+
+
+def parse_response(terms, response):
+    for line in response['lines']:
+        term = next(t for t in terms if t.term == line['term'])
+        for point in line['points']:
+            yield {
+                'term_id': term.id,
+                'day': datetime.strptime(point['date'], "%b %d %Y").date(),
+                'value': float(point['value'])
+            }
+
+
+def collect_google_scores(terms, start, end):
+    return parse_response(terms, query_google(terms, start, end))
 
 
 def calculate_moving_average(term, day, window_size):
@@ -122,37 +163,64 @@ def calculate_moving_average(term, day, window_size):
     return avg
 
 
-def calculate_moving_averages(model, day):
+def moving_average_matrix(model, start, end):
+    """Calculate the moving average of every one of the model's terms on every
+    day between start and end (inclusive)
+
+    Loads all the GoogleScores needed in one query, then uses cumulative sums
+    so that each window is a subtraction rather than a sum of its days.
+
+    Returns (terms, days, averages), where averages is a days by terms array.
+    Averages are NaN where the term is missing data in the window, those are
+    logged the same way as in calculate_moving_average.
+    """
     window_size = model.get_data()['average_window_size']
-    logger.debug('Calculating %d-day averages on %s' % (window_size, day))
-    for term in model.google_terms:
-        avg = calculate_moving_average(term, day, window_size)
-        if avg is None:
-            continue
-        yield (term.term, avg)
+    logger.debug('Calculating %d-day averages between %s and %s' % (window_size, start, end))
+    terms = model.google_terms.all()
+    columns = dict((t.id, i) for i, t in enumerate(terms))
+    first = start - timedelta(days=window_size - 1)
+    days = [start + timedelta(days=d) for d in xrange((end - start).days + 1)]
+
+    # Row 0 stays empty so that the window ending on row i is rows i-window+1..i
+    values = np.zeros(((end - first).days + 2, len(terms)))
+    present = np.zeros(values.shape)
+    if terms:
+        scores = db.session.query(GoogleScore.term_id, GoogleScore.day, GoogleScore.value).filter(
+            GoogleScore.term_id.in_(columns.keys()),
+            GoogleScore.day >= first,
+            GoogleScore.day <= end)
+        for term_id, day, value in scores:
+            row = (day - first).days + 1
+            values[row, columns[term_id]] = value
+            present[row, columns[term_id]] = 1
+    sums = np.cumsum(values, axis=0)
+    counts = np.cumsum(present, axis=0)
+    window_sums = sums[window_size:] - sums[:-window_size]
+    window_counts = counts[window_size:] - counts[:-window_size]
+
+    averages = np.where(window_counts == window_size, window_sums / window_size, np.nan)
+    for d, t in zip(*np.nonzero(window_counts != window_size)):
+        logger.warn('Not enough data to average %s on %s by %d days' % (terms[t], days[d], window_size))
+    return terms, days, averages
+
+
+def averages_on(terms, row):
+    """Pair up the terms with one day's row of a moving_average_matrix,
+    leaving out any terms without an average"""
+    return [(term.term, float(avg)) for term, avg in zip(terms, row) if not np.isnan(avg)]
 
 
-def get_model_score(model, day):
-    try:
-        ms = ModelScore.query.filter_by(model_id=model.id, day=day, region='e').one()
-    except NoResultFound:
-        ms = ModelScore()
-        ms.region = 'e'
-        ms.model = model
-        ms.day = day
-    return ms
+def calculate_moving_averages(model, day):
+    terms, days, averages = moving_average_matrix(model, day, day)
+    return averages_on(terms, averages[0])
 
 
-def calculate_score(model, day, engine_runner):
-    averages = list(calculate_moving_averages(model, day))
+def calculate_score(model, day, averages, engine_runner):
     if not averages:
         return
-    ms = get_model_score(model, day)
+    ms = {'model_id': model.id, 'day': day, 'region': 'e'}
     try:
-        if engine_runner.conf is CalculatorType.LEGACY:
-            ms.value = send_to_matlab(model, averages)
-        else:
-            ms.value = engine_runner.calculateModelScore(model, averages)
+        ms['value'] = engine_runner.calculateModelScore(model, averages)
     except ErrorReturnCode as e:
         logger.exception(e)
         raise e
@@ -168,6 +236,8 @@ def get_engine_conf():
             conf = CalculatorType.OCTAVE
         elif engine_type == 'remote':
             conf = CalculatorType.REMOTE
+        elif engine_type == 'native':
+            conf = CalculatorType.NATIVE
         else:
             conf = CalculatorType.LEGACY
     except KeyError as e:
@@ -175,66 +245,291 @@ def get_engine_conf():
     return conf
 
 
-def calculate_model_scores(model, start, end):
+def calculate_model_scores(model, start, end, engine_runner=None):
     logger.info('Calculating new ModelScores between %s and %s' % (start, end))
-    days_apart = (end - start).days + 1
-    engine_runner = buildCalculator(get_engine_conf())
-    days = (start + timedelta(days=d) for d in xrange(days_apart))
-    for day in days:
-        s = calculate_score(model, day, engine_runner)
-        if s:
-            yield s
+    if engine_runner is None:
+        engine_runner = buildCalculator(get_engine_conf())
+    terms, days, averages = moving_average_matrix(model, start, end)
+    days_averages = [(day, averages_on(terms, row)) for day, row in zip(days, averages)]
+    days_averages = [(day, a) for day, a in days_averages if a]
+    values = calculate_values(model, days_averages, engine_runner)
+    for (day, a), value in zip(days_averages, values):
+        yield {'model_id': model.id, 'day': day, 'region': 'e', 'value': value}
+
+
+def calculate_values(model, days_averages, engine_runner):
+    """Return the model's value for each (day, averages), using the values
+    cached from earlier runs with the same averages if SCORE_CACHE_SIZE is set"""
+    cache = get_score_cache()
+    function = model.get_data()['matlab_function']
+    if cache is not None:
+        keys = [score_key(function, a) for day, a in days_averages]
+        cached = cache.get_many(keys)
+        todo = [(key, (day, a)) for key, (day, a) in zip(keys, days_averages) if key not in cached]
+        logger.info('%d of %d values were cached' % (len(days_averages) - len(todo), len(days_averages)))
+    else:
+        todo = [(None, day_averages) for day_averages in days_averages]
+
+    if hasattr(engine_runner, 'calculateModelScores'):
+        # Score all the days in one call, rather than calling the engine for each
+        calculated = engine_runner.calculateModelScores(model, [a for key, (day, a) in todo])
+    else:
+        calculated = [calculate_score(model, day, a, engine_runner)['value'] for key, (day, a) in todo]
+
+    if cache is None:
+        return calculated
+    calculated = dict((key, value) for (key, day_averages), value in zip(todo, calculated))
+    cache.put_many(function, calculated)
+    cached.update(calculated)
+    return [cached[key] for key in keys]
+
+
+def build_engine_runner(conf):
+    """Return the calculator to run models with, a pool of CALCULATOR_WORKERS
+    processes if there's more than one and the engine runs locally"""
+    workers = calculator_workers()
+    if workers > 1 and conf in (CalculatorType.MATLAB, CalculatorType.OCTAVE):
+        return buildCalculatorPool(conf, workers)
+    return buildCalculator(conf)
+
+
+def missing_google_scores(model, start, end):
+    """Return the (term, day) pairs between start and end (inclusive) that
+    are missing a GoogleScore"""
+    terms = dict((t.id, t) for t in model.google_terms)
+    keys = db.session.query(model_google_terms.c.google_term_id.label('key')).filter(
+        model_google_terms.c.model_id == model.id)
+    missing = missing_scores(keys, GoogleScore.term_id, GoogleScore.day, start, end)
+    return [(terms[term_id], day) for term_id, day in missing]
 
 
 def days_missing_google_score(model, start, end):
-    requested = set(start + timedelta(days=i) for i in xrange((end - start).days + 1))
-    for term in model.google_terms:
-        known = set(s.day for s in term.scores)
-        for missing in requested - known:
-            yield missing
+    for term, day in missing_google_scores(model, start, end):
+        yield day
 
 
 def days_missing_model_score(model, start, end):
-    requested = set(start + timedelta(days=i) for i in xrange((end - start).days + 1))
-    known = set(s.day for s in model.scores)
-    for missing in requested - known:
-        yield missing
+    keys = db.session.query(Model.id.label('key')).filter(Model.id == model.id)
+    missing = missing_scores(keys, ModelScore.model_id, ModelScore.day, start, end, ModelScore.region == 'e')
+    for model_id, day in missing:
+        yield day
+
+
+def packing(n_terms, n_days):
+    """Return the fewest calls it takes to query n_terms over n_days within
+    the API's limits, and the number of terms per call that achieves it"""
+    options = []
+    for per_call in xrange(1, min(n_terms, MAX_TERMS) + 1):
+        days_per_call = MAX_POINTS // per_call
+        calls = -(-n_terms // per_call) * -(-n_days // days_per_call)
+        options.append((calls, -per_call))
+    calls, per_call = min(options)
+    return calls, -per_call
+
+
+def chunks(start, end, days):
+    """Split the days between start and end (inclusive) into consecutive
+    (start, end) spans of at most days days"""
+    s = start
+    while s <= end:
+        e = min(end, s + timedelta(days=days - 1))
+        yield s, e
+        s = e + timedelta(days=1)
+
+
+def pack(terms, start, end):
+    """Split querying terms between start and end (inclusive) into as few
+    calls as the API's limits allow, yielding (terms, start, end) for each"""
+    calls, per_call = packing(len(terms), (end - start).days + 1)
+    for batch_start in xrange(0, len(terms), per_call):
+        batch = terms[batch_start:batch_start + per_call]
+        for s, e in chunks(start, end, MAX_POINTS // len(batch)):
+            yield batch, s, e
 
 
 def batches(model, start, end):
-    max_response = 2000
-    max_terms = 30
+    """Calls to query every one of the model's terms between start and end"""
+    return pack(model.google_terms.all(), start, end)
 
-    terms = model.google_terms.all()
-    batch_intervals = xrange(0, len(terms), max_terms)
-    for batch_start in batch_intervals:
-        batch = terms[batch_start:batch_start + max_terms]
 
-        days_apart = min((end - start).days, max_response // len(batch))
-        s, e = start, start + timedelta(days=days_apart)
-        while e < end:
-            yield batch, s, e
-            s, e = e, e + timedelta(days=days_apart)
-        yield batch, s, end
+def needed_spans(days, lookback):
+    """Turn a term's sorted missing days into the spans to query
+
+    Each span goes back lookback days before its first missing day, so the
+    moving averages can be calculated. Spans that overlap or touch are merged.
+    """
+    spans = []
+    for day in days:
+        if spans and day - lookback <= spans[-1][1] + timedelta(days=1):
+            spans[-1][1] = day
+        else:
+            spans.append([day - lookback, day])
+    return [tuple(span) for span in spans]
+
+
+def group_cost(group):
+    start, end, terms = group
+    return packing(len(terms), (end - start).days + 1)[0]
+
+
+def plan(model, start, end):
+    """Plan the calls needed to collect the GoogleScores this model is
+    missing between start and end (inclusive)
+
+    Works out the spans each term is missing and groups the terms missing the
+    same span. Neighbouring groups are then merged, querying their terms over
+    both spans, whenever that takes fewer calls. Returns a list of
+    (terms, start, end) calls, each within the API's limits.
+    """
+    # Go back a day more than the averages need, to make sure the API can
+    # return some data. When the dates are near to date.today() you don't get
+    # empty responses you get 400s
+    lookback = timedelta(days=model.get_data()['average_window_size'])
+    spans = defaultdict(set)
+    for term, missing in groupby(missing_google_scores(model, start, end), key=lambda m: m[0]):
+        for span in needed_spans([day for _, day in missing], lookback):
+            spans[span].add(term)
+
+    groups = sorted((s, e, terms) for (s, e), terms in spans.iteritems())
+    while len(groups) > 1:
+        best = None
+        for i in xrange(len(groups) - 1):
+            a, b = groups[i], groups[i + 1]
+            merged = (min(a[0], b[0]), max(a[1], b[1]), a[2] | b[2])
+            saving = group_cost(a) + group_cost(b) - group_cost(merged)
+            if saving > 0 and (best is None or saving > best[0]):
+                best = (saving, i, merged)
+        if best is None:
+            break
+        saving, i, merged = best
+        groups[i:i + 2] = [merged]
+
+    calls = []
+    for s, e, terms in groups:
+        calls.extend(pack(sorted(terms, key=lambda t: t.id), s, e))
+    return calls
+
+
+class TokenBucket(object):
+    """A rate limiter shared between threads
+
+    Allows rate calls a second on average, in bursts of up to capacity calls.
+    """
 
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
 
-def run_batch(batch, start, end):
-    delay = 0
-    for attempt in xrange(1, 6):
+    def take(self):
+        """Block until a call is allowed"""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def fetch_settings():
+    """Return the (workers, requests per second) to query Google with"""
+    workers = int(os.environ.get('GOOGLE_FETCH_WORKERS', 4))
+    rate = float(os.environ.get('GOOGLE_REQUESTS_PER_SECOND', 1))
+    return workers, rate
+
+
+def terms_hash(terms):
+    """Identify a set of terms, whatever order they're in"""
+    return hashlib.sha256('\n'.join(sorted(terms)).encode('utf-8')).hexdigest()
+
+
+def fetch_batch(batch, start, end, bucket, cache=None, replay=False, attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+    """Collect one batch's GoogleScores, from the cache if it's there
+
+    Otherwise query Google, retrying HTTP errors with jittered exponential
+    backoff. In replay mode only the cache is used, however old the response.
+
+    Returns (scores, fetch), where fetch is the GoogleFetch record of the
+    call to Google or None if the cache was used. If the call fails, the
+    HttpError has the GoogleFetch record as its fetch attribute.
+    """
+    key = request_key([t.term for t in batch], start, end, GEO_REGION)
+    response = cache.get(key, expire=not replay) if cache else None
+    if response is not None:
+        logger.debug('Using cached response for %d terms between %s and %s' % (len(batch), start, end))
+        return list(parse_response(batch, response)), None
+    if replay:
+        raise FluDetectorError('No cached Google response for %d terms between %s and %s' % (len(batch), start, end))
+
+    fetch = {
+        'batch_id': uuid.uuid4().hex,
+        'terms_hash': terms_hash([t.term for t in batch]),
+        'start_date': start,
+        'end_date': end,
+        'row_count': 0
+    }
+    for attempt in xrange(1, attempts + 1):
+        bucket.take()
+        fetch['timestamp'] = datetime.utcnow()
+        fetch['retries'] = attempt - 1
+        began = time.time()
         try:
-            for gs in collect_google_scores(batch, start, end):
-                db.session.add(gs)
-                gl = GoogleLog()
-                gl.score_date = gs.day
-                gl.score_timestamp = datetime.utcnow()
-                db.session.add(gl)
-            return
+            response = query_google(batch, start, end)
+            fetch['latency'] = time.time() - began
+            fetch['status'] = 200
+            break
         except HttpError as e:
-            if attempt == 6:
+            fetch['latency'] = time.time() - began
+            fetch['status'] = int(e.resp.status)
+            if attempt == attempts:
+                e.fetch = fetch
                 raise e
-            delay = 3 ** attempt
-            logger.warn('HTTP error on attempt %d, sleeping and trying again in %d seconds' % (attempt, delay))
+            delay = backoff ** attempt * random.uniform(0.5, 1.5)
+            logger.warn('HTTP error on attempt %d, sleeping and trying again in %.1f seconds' % (attempt, delay))
             time.sleep(delay)
+    if cache:
+        cache.put(key, response)
+    scores = list(parse_response(batch, response))
+    fetch['row_count'] = len(scores)
+    return scores, fetch
+
+
+def fetch_batches(batched, workers, rate, **kwargs):
+    """Fetch the batches on a pool of threads, yielding each batch's
+    (scores, fetch) from fetch_batch as soon as they arrive
+
+    Up to workers batches are fetched at once, sharing a TokenBucket so that
+    between them they make at most rate requests a second. Any kwargs (e.g.
+    cache and replay) are passed on to fetch_batch.
+    """
+    bucket = TokenBucket(rate)
+    jobs = [([SearchTerm(t.id, t.term) for t in batch], s, e) for batch, s, e in batched]
+
+    def fetch(job):
+        return fetch_batch(*job, bucket=bucket, **kwargs)
+
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(fetch, jobs):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_google_scores(scores, fetch=None):
+    """Save and commit one batch's GoogleScores, along with the GoogleFetch
+    record of the call that got them"""
+    bulk_upsert(GoogleScore, scores)
+    if fetch:
+        db.session.add(GoogleFetch(**fetch))
+    db.session.commit()
 
 
 def send_score_to_message_queue(date, score):
@@ -245,62 +540,128 @@ def send_score_to_message_queue(date, score):
     client.disconnect()
 
 
-def run(model, start, end, **kwargs):
+def collect(model, start, end, replay=False):
+    """Collect and commit the GoogleScores this model is missing between
+    start and end (inclusive)"""
+    collect_batches(plan(model, start, end), replay)
+
+
+def collect_batches(batched, replay=False):
+    """Make and commit these planned calls to Google"""
+    if not batched:
+        logger.info('GoogleScores already collected')
+        return
+
+    workers, rate = fetch_settings()
+    td = timedelta(seconds=int(len(batched) / rate))
+    logger.info('Querying Google in %d batches, %d at a time, rate limiting means it will take at least %s' % (
+        len(batched), workers, str(td)))
+
+    cache = get_response_cache()
+    if replay and cache is None:
+        raise FluDetectorError('Replaying needs GOOGLE_CACHE_PATH to be set')
+
+    # The fetch threads only talk to Google, this thread does all the writing
+    try:
+        for scores, fetch in fetch_batches(batched, workers, rate, cache=cache, replay=replay):
+            write_google_scores(scores, fetch)
+    except HttpError as e:
+        write_google_scores([], getattr(e, 'fetch', None))
+        raise e
+
+
+def chunk_days():
+    """Return the number of days that runs commit at a time"""
+    return int(os.environ.get('RUN_CHUNK_DAYS', 30))
+
+
+def run(model, start, end, replay=False, resume=None, **kwargs):
     """
     Run this model between these two dates. Running the model means:
         1) Collecting Google Scores for the model's terms on these days
         2) Using the Google Scores to calculate the Model Scores
     Tries to be clever about when it needs to collect Google Data or not:
-        - Find dates between start and end that are missing a GoogleScore for
-            at least one of the terms
-        - Query for all terms over the smallest date range that covers all
-            missing dates.
+        - Find the days between start and end that each term is missing a
+            GoogleScore for, plus the days before them needed for averaging
+        - Query each term over just the spans it's missing, grouping terms
+            into as few calls as possible (see plan)
         - e.g. Same run twice won't hit Google the second time
         - e.g. Two runs that overlap will never query the days in common
         - e.g. Removing a term from a model won't cause extra queries
-        - e.g. Adding a term to a model will re-query every term
+        - e.g. Adding a term to a model will only query that term
+    Responses are cached if GOOGLE_CACHE_PATH is set, with replay=True only
+    the cache is used and Google is never queried.
+
+    The calls to Google are planned once for the whole run. The days are then
+    run RUN_CHUNK_DAYS at a time, making the calls that start by the end of
+    each chunk and committing its ModelScores along with a checkpoint in a
+    ModelRun. To carry on a failed run from its last checkpoint, pass its
+    ModelRun as resume (start and end are then ignored). A ModelRun is only
+    started if there's something to collect or calculate.
     """
-    logger.info("Run %s model between %s and %s" % (model.name, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
-
-    needs_collecting = list(days_missing_google_score(model, start, end))
-    if needs_collecting:
-        # Go back a day to make sure the API can return some data
-        # When the dates are near to date.today() you don't get empty responses
-        # you get 400s
-        window_size = model.get_data()['average_window_size']
-        collect_start = min(needs_collecting) - timedelta(days=window_size)
-        collect_end = max(needs_collecting)
-
-        batched = list(batches(model, collect_start, collect_end))
-        # Assuming 1 second to make and process call with worst case rate limiting
-        secs_per_batch = 5 + 3 + 3 ^ 2 + 3 ^ 3 + 3 ^ 4 + 3 ^ 5
-        td = timedelta(seconds=len(batched) * secs_per_batch)
-        logger.info('Due to rate limiting, querying Google will take at most %s' % str(td))
-
-        for batch, s, e in batched:
-            run_batch(batch, s, e)
-    else:
-        logger.info('GoogleScores already collected')
+    if resume is not None:
+        start, end = resume.resume_from, resume.end
+    pending = deque(sorted(plan(model, start, end), key=lambda call: call[1]))
+    if resume is None and not pending and next(days_missing_model_score(model, start, end), None) is None:
+        logger.info('%s model already run between %s and %s' % (
+            model.name, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+        return
 
-    msg_date = None
-    msg_value = None
-    needs_calculating = list(days_missing_model_score(model, start, end))
-    if needs_calculating:
-        calculate_start = min(needs_calculating)
-        calculate_end = max(needs_calculating)
-
-        td = timedelta(seconds=(calculate_end - calculate_start).days * 8)  # Assuming 8 seconds to process each day
-        logger.info('To process all days in Matlab/Octave will take roughly %s' % str(td))
-
-        for ms in calculate_model_scores(model, calculate_start, calculate_end):
-            db.session.add(ms)
-            if os.environ['TWITTER_ENABLED'] == 'True':
-                msg_date = ms.day
-                msg_value = ms.value
+    now = datetime.utcnow()
+    if resume is None:
+        model_run = ModelRun(model=model, start=start, end=end, started=now)
+        db.session.add(model_run)
     else:
-        logger.info('ModelScores already calculated')
+        model_run = resume
+    model_run.status = 'running'
+    model_run.updated = now
+    db.session.commit()
+    logger.info("Run %d of %s model between %s and %s" % (
+        model_run.id, model.name, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
 
+    engine_runner = None
+    latest = None
+    try:
+        for chunk_start, chunk_end in chunks(start, end, chunk_days()):
+            due = []
+            while pending and pending[0][1] <= chunk_end:
+                due.append(pending.popleft())
+            collect_batches(due, replay)
+
+            needs_calculating = list(days_missing_model_score(model, chunk_start, chunk_end))
+            if needs_calculating:
+                calculate_start = min(needs_calculating)
+                calculate_end = max(needs_calculating)
+
+                # Assuming 8 seconds to process each day, on each calculator worker
+                td = timedelta(seconds=(calculate_end - calculate_start).days * 8 / calculator_workers())
+                logger.info('To process these days in Matlab/Octave will take roughly %s' % str(td))
+
+                if engine_runner is None:
+                    engine_runner = build_engine_runner(get_engine_conf())
+                model_scores = list(calculate_model_scores(model, calculate_start, calculate_end, engine_runner))
+                bulk_upsert(ModelScore, model_scores)
+                if model_scores:
+                    latest = model_scores[-1]
+            else:
+                logger.info('ModelScores already calculated')
+
+            model_run.completed = chunk_end
+            model_run.updated = datetime.utcnow()
+            db.session.commit()
+            refresh_score_store(model, chunk_start, chunk_end)
+    except Exception:
+        db.session.rollback()
+        model_run.status = 'failed'
+        model_run.updated = datetime.utcnow()
+        db.session.commit()
+        logger.error('Run %d failed, resume it with: flask runmodel %d --resume %d' % (
+            model_run.id, model.id, model_run.id))
+        raise
+
+    model_run.status = 'complete'
+    model_run.updated = datetime.utcnow()
     db.session.commit()
-    if msg_date is not None and msg_value is not None:
-        send_score_to_message_queue(msg_date, msg_value)
+    if latest is not None and os.environ['TWITTER_ENABLED'] == 'True':
+        send_score_to_message_queue(latest['day'], latest['value'])
         logger.info('Latest ModelScore value sent to message queue')
@@ -12,7 +12,9 @@ from sh import cat, lzop, ssh, scp, ErrorReturnCode
 
 from fludetector.errors import FluDetectorError
 from fludetector.log import logger
-from fludetector.models import db, GoogleScore, ModelScore
+from fludetector.models import (
+    db, bulk_upsert, missing_scores, model_twitter_ngrams, refresh_score_store,
+    Model, ModelScore, TwitterScore)
 
 SINGLE_DAY_COMBINED_PATH = '/tmp/fludetector_twitter_single_day_combined'
 SINGLE_DAY_PATH = '/tmp/fludetector_twitter_single_day'
@@ -86,18 +88,17 @@ def calculate_model_scores(model, start, end):
 
 
 def days_missing_twitter_score(model, start, end):
-    requested = set(start + timedelta(days=i) for i in xrange((end - start).days))
-    for ngram in model.twitter_ngrams:
-        known = set(s.day for s in ngram.scores)
-        for missing in requested - known:
-            yield missing
+    # The end day is excluded here
+    keys = db.session.query(model_twitter_ngrams.c.twitter_ngram_id.label('key')).filter(
+        model_twitter_ngrams.c.model_id == model.id)
+    for ngram_id, day in missing_scores(keys, TwitterScore.ngram_id, TwitterScore.day, start, end - timedelta(days=1)):
+        yield day
 
 
 def days_missing_model_score(model, start, end):
-    requested = set(start + timedelta(days=i) for i in xrange((end - start).days))
-    known = set(s.day for s in model.scores)
-    for missing in requested - known:
-        yield missing
+    keys = db.session.query(Model.id.label('key')).filter(Model.id == model.id)
+    for model_id, day in missing_scores(keys, ModelScore.model_id, ModelScore.day, start, end - timedelta(days=1)):
+        yield day
 
 
 def run(model, start, end, **kwargs):
@@ -118,8 +119,7 @@ def run(model, start, end, **kwargs):
         s = min(missing_twitter_score)
         e = max(missing_twitter_score)
         logger.info('Calculating TwitterScores between %s and %s' % (s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d')))
-        for ts in calculate_twitter_scores(model, s, e):
-            db.session.add(ts)
+        bulk_upsert(TwitterScore, calculate_twitter_scores(model, s, e))
     else:
         logger.info('TwitterScores already calculated')
 
@@ -127,9 +127,9 @@ def run(model, start, end, **kwargs):
     if missing_model_score:
         s = min(missing_model_score)
         e = max(missing_model_score)
-        for ms in calculate_model_scores(model, s, e):
-            db.session.add(ms)
+        bulk_upsert(ModelScore, calculate_model_scores(model, s, e))
     else:
         logger.info('ModelScores already calculated')
 
     db.session.commit()
+    refresh_score_store(model, start, end)
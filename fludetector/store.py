@@ -0,0 +1,155 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+
+
+This module keeps an optional, read-only copy of the ModelScores on disk as
+flat arrays, so the website can serve scores without going through the ORM.
+
+Each model and region gets two files in the SCORE_STORE_PATH directory:
+    MODEL_ID-REGION.values - float64 values, one per day since EPOCH
+    MODEL_ID-REGION.valid - A bitmap, one bit per day, set if there's a score
+
+The files are memory mapped read-only by every request, so all the gunicorn
+workers share the same pages through the OS page cache. The database is
+still the source of truth, the files are rewritten after scores are
+committed (see models.refresh_score_store) and can be rebuilt from scratch
+with `flask buildstore`.
+"""
+import os
+from datetime import date, timedelta
+
+import numpy as np
+from flask import current_app
+
+EPOCH = date(2000, 1, 1)
+
+
+def get_store():
+    """Return the app's ScoreStore, or None if SCORE_STORE_PATH isn't configured"""
+    path = current_app.config.get('SCORE_STORE_PATH')
+    if path:
+        return ScoreStore(path)
+
+
+def grow(path, size):
+    """Extend the file at path with zeros so that it's at least size bytes long"""
+    with open(path, 'ab') as fd:
+        if fd.tell() < size:
+            fd.truncate(size)
+
+
+class ScoreStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def paths(self, model_id, region):
+        base = os.path.join(self.path, '%d-%s' % (model_id, region))
+        return base + '.values', base + '.valid'
+
+    def read(self, model_id, region, start, end):
+        """Return the (days, values) stored between start and end (inclusive)
+
+        Returns None if this series hasn't been written to the store, in which
+        case the caller should read from the database instead.
+        """
+        values_path, valid_path = self.paths(model_id, region)
+        if start < EPOCH or not os.path.exists(valid_path):
+            return None
+
+        first = (start - EPOCH).days
+        stop = (end - EPOCH).days + 1
+        length = os.path.getsize(values_path) // 8
+        stop = min(stop, length)
+        if stop <= first:
+            return [], np.zeros(0)
+
+        valid = np.memmap(valid_path, dtype=np.uint8, mode='r')
+        bits = np.unpackbits(valid[first // 8:(stop + 7) // 8])
+        bits = bits[first % 8:first % 8 + stop - first].astype(bool)
+        offsets = np.flatnonzero(bits)
+
+        values = np.memmap(values_path, dtype=np.float64, mode='r', shape=(length,))
+        values = np.array(values[first:stop][offsets])
+        return [start + timedelta(days=int(o)) for o in offsets], values
+
+    def regions(self, model_id):
+        """Return the regions this model has a series for"""
+        if not os.path.isdir(self.path):
+            return set()
+        prefix = '%d-' % model_id
+        return set(name[len(prefix):-len('.valid')] for name in os.listdir(self.path)
+                   if name.startswith(prefix) and name.endswith('.valid'))
+
+    def write(self, model_id, region, days, values, start=None, end=None):
+        """Store the values for these days, leaving any other days untouched
+
+        If start and end are given, every other day between them (inclusive)
+        is marked as missing, e.g. because its ModelScore was deleted.
+        """
+        offsets = np.array([(d - EPOCH).days for d in days], dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        keep = offsets >= 0
+        offsets, values = offsets[keep], values[keep]
+        values_path, valid_path = self.paths(model_id, region)
+        if not len(offsets) and (start is None or not os.path.exists(valid_path)):
+            return
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        length = int(offsets.max()) + 1 if len(offsets) else 0
+        grow(values_path, length * 8)
+        grow(valid_path, (length + 7) // 8)
+
+        # Values go in before the valid bits are set, so readers never see a
+        # day as valid before its value is there
+        if len(offsets):
+            stored = np.memmap(values_path, dtype=np.float64, mode='r+')
+            stored[offsets] = values
+            stored.flush()
+            del stored
+
+        if not os.path.getsize(valid_path):
+            return
+        valid = np.memmap(valid_path, dtype=np.uint8, mode='r+')
+        if start is None:
+            masks = np.left_shift(1, 7 - offsets % 8).astype(np.uint8)
+            np.bitwise_or.at(valid, offsets // 8, masks)
+        else:
+            # Each byte of the range is written once with its new bits, so
+            # readers never see the days being written as missing
+            first = max((start - EPOCH).days, 0)
+            stop = min((end - EPOCH).days + 1, len(valid) * 8)
+            if stop > first:
+                low, high = first // 8, (stop + 7) // 8
+                bits = np.unpackbits(valid[low:high])
+                bits[first - low * 8:stop - low * 8] = 0
+                bits[offsets[(offsets >= first) & (offsets < stop)] - low * 8] = 1
+                valid[low:high] = np.packbits(bits)
+        valid.flush()
+        del valid
+
+    def remove(self, model_id, region=None):
+        """Delete the files for this model's series, all regions by default"""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            stem, _ = os.path.splitext(name)
+            if stem.split('-')[0] == str(model_id) and region in (None, stem.split('-')[-1]):
+                os.remove(os.path.join(self.path, name))
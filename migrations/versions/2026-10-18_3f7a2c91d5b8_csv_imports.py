@@ -0,0 +1,40 @@
+"""csv imports
+
+The CSV files imported into each model, so unchanged files can be skipped.
+
+Revision ID: 3f7a2c91d5b8
+Revises: 9d1c6b0e7a42
+Create Date: 2026-10-18 12:02:51.630954
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f7a2c91d5b8'
+down_revision = '9d1c6b0e7a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'csv_import',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sha256', sa.Text(), nullable=False),
+        sa.Column('filename', sa.Text(), nullable=False),
+        sa.Column('start', sa.Date(), nullable=False),
+        sa.Column('end', sa.Date(), nullable=False),
+        sa.Column('imported', sa.DateTime(), nullable=False),
+        sa.Column('rows', sa.Integer(), nullable=False),
+        sa.Column('model_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['model_id'], ['model.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_csv_import_sha256'), 'csv_import', ['sha256'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_csv_import_sha256'), table_name='csv_import')
+    op.drop_table('csv_import')
@@ -0,0 +1,38 @@
+"""model runs
+
+Checkpoints for model runs, so failed runs can be resumed.
+
+Revision ID: 65952beb4dea
+Revises: f24dae0ddf6d
+Create Date: 2026-10-18 10:52:19.046113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '65952beb4dea'
+down_revision = 'f24dae0ddf6d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'model_run',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('start', sa.Date(), nullable=False),
+        sa.Column('end', sa.Date(), nullable=False),
+        sa.Column('completed', sa.Date(), nullable=True),
+        sa.Column('status', sa.Text(), nullable=False),
+        sa.Column('started', sa.DateTime(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        sa.Column('model_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['model_id'], ['model.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('model_run')
@@ -0,0 +1,37 @@
+"""cached model scores
+
+Values calculated by model functions, so they aren't calculated again.
+
+Revision ID: 9d1c6b0e7a42
+Revises: 65952beb4dea
+Create Date: 2026-10-18 11:24:37.208115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d1c6b0e7a42'
+down_revision = '65952beb4dea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cached_model_score',
+        sa.Column('key', sa.Text(), nullable=False),
+        sa.Column('function', sa.Text(), nullable=False),
+        sa.Column('value', sa.Float(), nullable=False),
+        sa.Column('used', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_cached_model_score_function'), 'cached_model_score', ['function'], unique=False)
+    op.create_index(op.f('ix_cached_model_score_used'), 'cached_model_score', ['used'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_cached_model_score_used'), table_name='cached_model_score')
+    op.drop_index(op.f('ix_cached_model_score_function'), table_name='cached_model_score')
+    op.drop_table('cached_model_score')
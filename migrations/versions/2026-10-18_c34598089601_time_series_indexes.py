@@ -0,0 +1,31 @@
+"""time series indexes
+
+The score tables' primary keys lead with the day, but every query filters by
+model/term/ngram first and then by a range of days. These indexes match that.
+
+Revision ID: c34598089601
+Revises: 539f82b608a7
+Create Date: 2026-10-18 10:12:41.302214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c34598089601'
+down_revision = '539f82b608a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_model_score_model_id_region_day', 'model_score', ['model_id', 'region', 'day'], unique=False)
+    op.create_index('ix_google_score_term_id_day', 'google_score', ['term_id', 'day'], unique=False)
+    op.create_index('ix_twitter_score_ngram_id_day', 'twitter_score', ['ngram_id', 'day'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_twitter_score_ngram_id_day', table_name='twitter_score')
+    op.drop_index('ix_google_score_term_id_day', table_name='google_score')
+    op.drop_index('ix_model_score_model_id_region_day', table_name='model_score')
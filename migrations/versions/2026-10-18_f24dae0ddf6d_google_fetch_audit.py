@@ -0,0 +1,103 @@
+"""google fetch audit
+
+Replaces google_log, which had a row for every GoogleScore collected, with
+google_fetch, which has a row for every call to Google. Every old row has its
+own timestamp, but the rows a run logged were all written within moments of
+each other, so they are compacted into one google_fetch row per run: a new one
+starts wherever the gap between consecutive timestamps is more than GAP. Run
+VACUUM afterwards to give the space back.
+
+Downgrading expands each fetch back into one google_log row per day.
+
+Revision ID: f24dae0ddf6d
+Revises: c34598089601
+Create Date: 2026-10-18 10:31:07.518240
+
+"""
+from datetime import timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f24dae0ddf6d'
+down_revision = 'c34598089601'
+branch_labels = None
+depends_on = None
+
+GAP = timedelta(minutes=1)
+CHUNK_SIZE = 500
+
+google_log = sa.table(
+    'google_log',
+    sa.column('score_timestamp', sa.DateTime),
+    sa.column('score_date', sa.Date))
+
+google_fetch = sa.table(
+    'google_fetch',
+    sa.column('start_date', sa.Date),
+    sa.column('end_date', sa.Date),
+    sa.column('timestamp', sa.DateTime),
+    sa.column('status', sa.Integer),
+    sa.column('row_count', sa.Integer))
+
+
+def compact(bind):
+    """Write a google_fetch row for each run's google_log rows"""
+    rows = bind.execute(sa.select([google_log.c.score_timestamp, google_log.c.score_date]).order_by(
+        google_log.c.score_timestamp))
+    records = []
+    record = last = None
+    for timestamp, day in rows:
+        if record is None or timestamp - last > GAP:
+            record = {'start_date': day, 'end_date': day, 'timestamp': timestamp, 'status': 200, 'row_count': 0}
+            records.append(record)
+            if len(records) > CHUNK_SIZE:
+                bind.execute(google_fetch.insert(), records[:-1])
+                del records[:-1]
+        record['start_date'] = min(record['start_date'], day)
+        record['end_date'] = max(record['end_date'], day)
+        record['row_count'] += 1
+        last = timestamp
+    if records:
+        bind.execute(google_fetch.insert(), records)
+
+
+def upgrade():
+    op.create_table(
+        'google_fetch',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('batch_id', sa.Text(), nullable=True),
+        sa.Column('terms_hash', sa.Text(), nullable=True),
+        sa.Column('start_date', sa.Date(), nullable=False),
+        sa.Column('end_date', sa.Date(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('status', sa.Integer(), nullable=True),
+        sa.Column('latency', sa.Float(), nullable=True),
+        sa.Column('retries', sa.Integer(), nullable=True),
+        sa.Column('row_count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    # google_log was never in a migration, databases made by initdb have it
+    if 'google_log' in sa.inspect(op.get_bind()).get_table_names():
+        compact(op.get_bind())
+        op.drop_table('google_log')
+
+
+def downgrade():
+    op.create_table(
+        'google_log',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('score_timestamp', sa.DateTime(), nullable=False),
+        sa.Column('score_date', sa.Date(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(
+        "WITH RECURSIVE days(fetch_id, day) AS ("
+        "SELECT id, start_date FROM google_fetch WHERE status = 200 UNION ALL "
+        "SELECT fetch_id, date(day, '+1 day') FROM days JOIN google_fetch ON google_fetch.id = fetch_id "
+        "WHERE day < google_fetch.end_date) "
+        "INSERT INTO google_log (score_timestamp, score_date) "
+        "SELECT timestamp, day FROM days JOIN google_fetch ON google_fetch.id = fetch_id ORDER BY fetch_id, day")
+    op.drop_table('google_fetch')
@@ -27,4 +27,6 @@ set -e
 
 D=$(date +%Y-%m-%d-%H:%M:%S)
 
-cp data.db /cs/research/fmedia/fmedia12/fludetector-backups/$D-data.db
+# The database runs in WAL mode, so recent changes might only be in data.db-wal.
+# SQLite's backup command takes a consistent copy of both.
+sqlite3 data.db ".backup /cs/research/fmedia/fmedia12/fludetector-backups/$D-data.db"
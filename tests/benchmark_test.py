@@ -0,0 +1,68 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from fludetector.benchmark import FakeTrends, fake_score, run_benchmark
+import datetime
+import httplib2
+import json
+import unittest
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def get(self, server, terms, start, end):
+        query = '&'.join(['terms=%s' % t for t in terms] + [
+            'time.startDate=%s' % start, 'time.endDate=%s' % end, 'geoRestriction.region=GB-ENG'])
+        response, content = httplib2.Http().request(server.url + 'trends/v1beta/timelinesForHealth?' + query)
+        return response.status, json.loads(content)
+
+    def testFakeTrends(self):
+        """ Answers like the Trends API, including its limits and errors """
+        with FakeTrends(padding=5) as server:
+            status, body = self.get(server, ['flu', 'cough'], '2018-01-30', '2018-02-02')
+            self.assertEqual(status, 200)
+            self.assertEqual([line['term'] for line in body['lines']], ['flu', 'cough'])
+            points = body['lines'][0]['points']
+            self.assertEqual([p['date'] for p in points], ['Jan 30 2018', 'Jan 31 2018', 'Feb 01 2018', 'Feb 02 2018'])
+            self.assertEqual(points[0]['value'], fake_score(u'flu', datetime.date(2018, 1, 30)))
+            self.assertEqual(points[0]['padding'], 'xxxxx')
+
+            status, body = self.get(server, ['flu'] * 2, '2018-01-01', '2020-12-31')
+            self.assertEqual(status, 400)
+            self.assertEqual(server.requests, 2)
+
+        with FakeTrends(error_rate=1) as server:
+            status, body = self.get(server, ['flu'], '2018-01-01', '2018-01-02')
+            self.assertEqual(status, 503)
+
+    def testRunBenchmark(self):
+        """ Times each stage of a run against the fake API """
+        results = run_benchmark(5, 30, workers=2)
+        self.assertEqual(results.keys(), ['collection', 'averaging', 'calculation', 'commit'])
+        self.assertEqual(results['collection']['requests'], 1)
+        self.assertGreater(results['collection']['queries'], 0)
+        # Just the model's terms and their GoogleScores, not a query for each day
+        self.assertEqual(results['calculation']['queries'], 2)
+        self.assertEqual(sum(r['requests'] for r in results.values()), 1)
+        for result in results.values():
+            self.assertGreaterEqual(result['seconds'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
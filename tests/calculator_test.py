@@ -0,0 +1,151 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from fludetector.calculator import CalculatorPool, LocalOctave, averages_matrix, read_scores, write_averages, write_averages_matrix
+from fludetector.errors import FluDetectorError
+from StringIO import StringIO
+import numpy as np
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+
+class FakeModel(object):
+
+    def get_data(self):
+        return {'matlab_function': 'fake'}
+
+
+class FakeCalculator(object):
+    """Sums the averages, dying the first time it sees a 3 if crash is set"""
+
+    def __init__(self, crash=None):
+        self.crash = crash
+        self.pid = os.getpid()
+
+    def calculate(self, function, averages):
+        if function != 'fake':
+            raise ValueError(function)
+        total = sum(avg for term, avg in averages)
+        if total == 3 and self.crash and not os.path.exists(self.crash):
+            open(self.crash, 'w').close()
+            os._exit(1)
+        return total
+
+    def calculateMany(self, function, days_averages):
+        return [self.calculate(function, averages) for averages in days_averages]
+
+
+class LocalOctaveTest(unittest.TestCase):
+
+    def testLazySession(self):
+        """ Octave isn't started until a worker first scores something """
+        self.assertIsNone(LocalOctave().session)
+
+
+class BatchFilesTest(unittest.TestCase):
+
+    def testAveragesMatrix(self):
+        """ A row for each day and a column for each term, keeping full precision """
+        terms, X = averages_matrix([[('flu', 0.1234567891234), ('cough', 2.0)], [('fever', 1e-9)]])
+        self.assertEqual(terms, ['flu', 'cough', 'fever'])
+        np.testing.assert_array_equal(X, [[0.1234567891234, 2.0, np.nan], [np.nan, np.nan, 1e-9]])
+
+    def testWriteAveragesMatrix(self):
+        """ A line of every term's average for each day, NaN where it's missing """
+        fh = StringIO()
+        write_averages_matrix(fh, [[('flu', 1.5), ('cough', 2.0)], [('cough', 3.0), ('fever', 1.25e-7)]])
+        lines = fh.getvalue().splitlines()
+        self.assertEqual(lines[:2], ['flu,cough,fever', '1.5,2,NaN'])
+        self.assertEqual(lines[2].split(',')[:2], ['NaN', '3'])
+        self.assertEqual(float(lines[2].split(',')[2]), 1.25e-7)
+
+    def testWriteAverages(self):
+        """ Averages are written in full precision """
+        fh = StringIO()
+        write_averages(fh, [('flu', 0.1), ('cough', 1.25e-7)])
+        lines = [line.split(',') for line in fh.getvalue().split('\n')]
+        self.assertEqual([(term, float(avg)) for term, avg in lines], [('flu', 0.1), ('cough', 1.25e-7)])
+
+    def testReadScores(self):
+        self.assertEqual(read_scores(StringIO('1.5\n2\n-0.25\n'), 3), [1.5, 2.0, -0.25])
+        with self.assertRaises(FluDetectorError):
+            read_scores(StringIO('1.5\n'), 2)
+
+
+class CalculatorPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testCalculateModelScores(self):
+        """ Scores every day in order, across the workers """
+        pool = CalculatorPool(FakeCalculator, 3)
+        try:
+            averages = [[('flu', float(i)), ('cough', 1.0)] for i in xrange(10)]
+            self.assertEqual(pool.calculateModelScores(FakeModel(), averages), range(1, 11))
+            self.assertEqual(pool.calculateModelScore(FakeModel(), [('flu', 2.0)]), 2.0)
+        finally:
+            pool.close()
+
+    def testRestartsDeadWorkers(self):
+        """ A worker that dies is restarted, and its day calculated again """
+        crash = os.path.join(self.path, 'crashed')
+        pool = CalculatorPool(lambda: FakeCalculator(crash), 2)
+        try:
+            averages = [[('flu', float(i))] for i in xrange(6)]
+            self.assertEqual(pool.calculateModelScores(FakeModel(), averages), range(6))
+            self.assertTrue(os.path.exists(crash))
+            self.assertTrue(all(process.is_alive() for process, tasks in pool.workers))
+        finally:
+            pool.close()
+
+    def testRestartsIdleDeadWorkers(self):
+        """ A worker that died between calls is restarted before it's sent more days """
+        pool = CalculatorPool(FakeCalculator, 1)
+        try:
+            self.assertEqual(pool.calculateModelScores(FakeModel(), [[('flu', 1.0)]]), [1.0])
+            process = pool.workers[0][0]
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+            self.assertEqual(pool.calculateModelScores(FakeModel(), [[('flu', 2.0)], [('flu', 3.0)]]), [2.0, 3.0])
+            self.assertTrue(pool.workers[0][0].is_alive())
+        finally:
+            pool.close()
+
+    def testFailure(self):
+        """ Errors in the calculator are raised """
+        class Model(object):
+            def get_data(self):
+                return {'matlab_function': 'missing'}
+        pool = CalculatorPool(FakeCalculator, 2)
+        try:
+            with self.assertRaises(FluDetectorError):
+                pool.calculateModelScores(Model(), [[('flu', 1.0)]])
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from StringIO import StringIO
+from flask import Flask
+from fludetector.errors import FluDetectorError
+from fludetector.models import db, CsvImport, Model, ModelScore
+from fludetector.sources import csv_
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+CSV = """Date,England,London,Notes
+2018-01-01,1.5,2.5,
+2018-01-02,1.6,n/a,
+2018-01-03,1.7,2.7,
+2018-01-04,1.8,2.8,
+"""
+
+
+class CsvTest(unittest.TestCase):
+
+    @staticmethod
+    def create_app():
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.app_context().push()
+        return app
+
+    def setUp(self):
+        db.init_app(CsvTest.create_app())
+        db.create_all()
+        db.engine.execute('insert into model values (1, "Test Model", "csv", 1, NULL)')
+        db.engine.execute('insert into model_score values ("2018-01-01", "e", 100.0, 1)')
+        db.engine.execute('insert into model_score values ("2018-01-02", "e", 100.0, 1)')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def testRun(self):
+        """ Cells in the date range are inserted or replace existing scores, others are skipped """
+        model = Model.query.get(1)
+        csv_.run(model, datetime.date(2018, 1, 2), datetime.date(2018, 1, 3), csv_file=StringIO(CSV))
+        scores = dict(((s.day.day, s.region), s.value) for s in ModelScore.query)
+        self.assertEqual(scores, {
+            (1, 'e'): 100.0,
+            (2, 'e'): 1.6,
+            (3, 'e'): 1.7,
+            (3, 'l'): 2.7})
+
+
+    def testChunks(self):
+        """ Each chunk is committed as it's read, and the import is counted """
+        model = Model.query.get(1)
+        commits = []
+        commit = db.session.commit
+        db.session.commit = lambda: commits.append(ModelScore.query.count()) or commit()
+        try:
+            stats = csv_.run(model, datetime.date(2018, 1, 1), datetime.date(2018, 1, 3),
+                             csv_file=StringIO(CSV), chunk_size=2)
+        finally:
+            db.session.commit = commit
+        self.assertEqual(stats, {'rows': 4, 'skipped': 1, 'added': 3, 'replaced': 2})
+        self.assertEqual(commits, [3, 4, 5])
+
+    def testFailure(self):
+        """ The chunks committed before a bad row are kept and copied to the store """
+        model = Model.query.get(1)
+        refreshed = []
+        refresh = csv_.refresh_score_store
+        csv_.refresh_score_store = lambda model, start, end: refreshed.append((start, end))
+        try:
+            with self.assertRaises(ValueError):
+                csv_.run(model, datetime.date(2018, 1, 1), datetime.date(2018, 1, 4),
+                         csv_file=StringIO(CSV.replace('2018-01-04', 'tomorrow')), chunk_size=2)
+        finally:
+            csv_.refresh_score_store = refresh
+        self.assertEqual(refreshed, [(datetime.date(2018, 1, 1), datetime.date(2018, 1, 4))])
+        self.assertEqual(ModelScore.query.filter(ModelScore.value != 100).count(), 4)
+
+    def testFiles(self):
+        """ A directory or glob of files are all imported, later files winning, and unchanged files are skipped """
+        path = tempfile.mkdtemp()
+        try:
+            for name, content in (('a.csv', CSV), ('b.csv', 'Date,England\n2018-01-03,9.5\n'), ('notes.txt', '')):
+                with open(os.path.join(path, name), 'w') as fh:
+                    fh.write(content)
+            model = Model.query.get(1)
+            start, end = datetime.date(2018, 1, 1), datetime.date(2018, 1, 4)
+
+            stats = csv_.run(model, start, end, csv_file=path)
+            self.assertEqual(stats['files'], 2)
+            self.assertEqual(stats['rows'], 5)
+            self.assertEqual(stats['added'], 5)
+            self.assertEqual(stats['replaced'], 3)
+            scores = dict(((s.day.day, s.region), s.value) for s in ModelScore.query)
+            self.assertEqual(scores[(3, 'e')], 9.5)
+            self.assertEqual(scores[(4, 'l')], 2.8)
+            self.assertEqual(CsvImport.query.count(), 2)
+
+            stats = csv_.run(model, start, end, csv_file=os.path.join(path, '*.csv'))
+            self.assertEqual((stats['files'], stats['unchanged_files'], stats['rows']), (0, 2, 0))
+
+            # A wider range than before is imported again
+            with open(os.path.join(path, 'b.csv'), 'a') as fh:
+                fh.write('2018-01-04,10.5\n')
+            stats = csv_.run(model, start, end + datetime.timedelta(days=1), csv_file=path)
+            self.assertEqual((stats['files'], stats['unchanged_files']), (2, 0))
+            self.assertEqual(ModelScore.query.filter_by(region='e').order_by(ModelScore.day.desc()).first().value, 10.5)
+
+            with self.assertRaises(FluDetectorError):
+                csv_.run(model, start, end, csv_file=os.path.join(path, 'missing', '*.csv'))
+        finally:
+            shutil.rmtree(path)
+
+    def testReimport(self):
+        """ Files after one that's imported again are imported again too, so the last one still wins """
+        path = tempfile.mkdtemp()
+        try:
+            for name, content in (('a.csv', CSV), ('b.csv', 'Date,England\n2018-01-03,9.5\n'), ('c.csv', CSV.replace('1.7', '1.9'))):
+                with open(os.path.join(path, name), 'w') as fh:
+                    fh.write(content)
+            model = Model.query.get(1)
+            start, end = datetime.date(2018, 1, 1), datetime.date(2018, 1, 4)
+            csv_.run(model, start, end, csv_file=os.path.join(path, '[ab].csv'))
+
+            with open(os.path.join(path, 'a.csv'), 'w') as fh:
+                fh.write(CSV.replace('1.7', '5.7'))
+            stats = csv_.run(model, start, end, csv_file=os.path.join(path, '[ab].csv'))
+            self.assertEqual((stats['files'], stats['unchanged_files']), (2, 0))
+            self.assertEqual(ModelScore.query.filter_by(day=datetime.date(2018, 1, 3), region='e').one().value, 9.5)
+
+            # Only the files from the first changed one on are imported
+            stats = csv_.run(model, start, end, csv_file=path)
+            self.assertEqual((stats['files'], stats['unchanged_files']), (1, 2))
+            self.assertEqual(ModelScore.query.filter_by(day=datetime.date(2018, 1, 3), region='e').one().value, 1.9)
+        finally:
+            shutil.rmtree(path)
+
+    def testBadFile(self):
+        """ A file that can't be read fails the import, after the files before it are written """
+        path = tempfile.mkdtemp()
+        os.environ['CSV_IMPORT_WORKERS'] = '1'
+        try:
+            for name, content in (('a.csv', CSV), ('b.csv', 'Date,England\ntomorrow,9.5\n'), ('c.csv', CSV)):
+                with open(os.path.join(path, name), 'w') as fh:
+                    fh.write(content)
+            model = Model.query.get(1)
+            with self.assertRaises(FluDetectorError):
+                csv_.run(model, datetime.date(2018, 1, 1), datetime.date(2018, 1, 4), csv_file=path)
+            self.assertEqual([i.filename for i in CsvImport.query], ['a.csv'])
+            self.assertEqual(ModelScore.query.count(), 7)
+        finally:
+            del os.environ['CSV_IMPORT_WORKERS']
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
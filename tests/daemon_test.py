@@ -0,0 +1,105 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from fludetector.calculator import read_message, send_message, RemoteCalculator
+from fludetector.daemon import CalculatorDaemon, FakeEngine
+from fludetector.errors import FluDetectorError
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import unittest
+
+
+class FakeModel(object):
+
+    def __init__(self, function):
+        self.function = function
+
+    def get_data(self):
+        return {'matlab_function': self.function}
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.socket = os.path.join(self.path, 'calculator.sock')
+        self.daemon = CalculatorDaemon(self.socket, FakeEngine, workers=2)
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.daemon.server_close()
+        shutil.rmtree(self.path)
+
+    def testRemoteCalculator(self):
+        """ Scores days on the daemon, in order """
+        calculator = RemoteCalculator(self.socket)
+        days = [[('flu', i), ('cough', 0.5)] for i in xrange(5)]
+        self.assertEqual(calculator.calculateModelScores(FakeModel('flu'), days), [0.5, 1.5, 2.5, 3.5, 4.5])
+        self.assertEqual(calculator.calculateModelScore(FakeModel('flu'), [('flu', 0.25)]), 0.25)
+        self.assertEqual(calculator.calculateModelScores(FakeModel('flu'), []), [])
+
+    def testErrors(self):
+        """ Engine failures are reported, and the daemon carries on """
+        calculator = RemoteCalculator(self.socket)
+        with self.assertRaises(FluDetectorError):
+            calculator.calculateModelScore(FakeModel('fail'), [('flu', 1.0)])
+        self.assertEqual(calculator.calculateModelScore(FakeModel('flu'), [('flu', 1.0)]), 1.0)
+        with self.assertRaises(FluDetectorError):
+            RemoteCalculator(os.path.join(self.path, 'missing.sock')).calculate('flu', [('flu', 1.0)])
+
+    def testSocketPermissions(self):
+        """ Only the daemon's user can connect """
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket).st_mode), 0o600)
+
+    def testAlreadyRunning(self):
+        """ Refuses to take over the socket of a running daemon, but replaces a stale one """
+        with self.assertRaises(FluDetectorError):
+            CalculatorDaemon(self.socket, FakeEngine)
+        self.assertEqual(RemoteCalculator(self.socket).calculate('flu', [('flu', 1.0)]), 1.0)
+
+        stale = os.path.join(self.path, 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(stale)
+        sock.close()
+        CalculatorDaemon(stale, FakeEngine).server_close()
+
+    def testProtocol(self):
+        """ A connection can be used for many jobs """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket)
+        fh = sock.makefile('rw')
+        try:
+            send_message(fh, {'function': 'flu', 'days': [[['flu', 1.5]], [['flu', 2], ['cough', 3]]]})
+            self.assertEqual(read_message(fh), {'scores': [1.5, 5]})
+            send_message(fh, {'days': []})
+            self.assertIn('error', read_message(fh))
+        finally:
+            fh.close()
+            sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from flask import Flask
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpMockSequence
+from httplib2 import Response
+from fludetector.models import db, GoogleFetch, GoogleScore, GoogleTerm
+from fludetector.sources import google
+from fludetector.benchmark import environ, FakeTrends
+from fludetector.cache import ResponseCache, request_key
+from fludetector.errors import FluDetectorError
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class FakeQuery(object):
+    """Stands in for query_google: every call takes latency seconds, and the
+    first failures calls for each term are HTTP 503s"""
+
+    def __init__(self, latency=0.05, failures=0):
+        self.latency = latency
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+        self.calls = []
+        self.failed = {}
+
+    def __call__(self, terms, start, end):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+            self.calls.append(time.time())
+        try:
+            time.sleep(self.latency)
+            with self.lock:
+                key = terms[0].id
+                self.failed[key] = self.failed.get(key, 0) + 1
+                if self.failed[key] <= self.failures:
+                    raise HttpError(Response({'status': 503}), 'Service Unavailable')
+            days = [start + datetime.timedelta(days=i) for i in xrange((end - start).days + 1)]
+            return {'lines': [
+                {'term': t.term, 'points': [{'date': d.strftime('%b %d %Y'), 'value': t.id} for d in days]}
+                for t in terms]}
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class FetchTest(unittest.TestCase):
+
+    @staticmethod
+    def create_app():
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.app_context().push()
+        return app
+
+    def setUp(self):
+        db.init_app(FetchTest.create_app())
+        db.create_all()
+        for i in xrange(1, 9):
+            db.engine.execute('insert into google_term values (?, ?)', i, 'Term %d' % i)
+        self.start = datetime.date(2018, 1, 1)
+        self.end = datetime.date(2018, 1, 10)
+        self.batched = [([t], self.start, self.end) for t in GoogleTerm.query.order_by(GoogleTerm.id)]
+        self.query_google = google.query_google
+        self.build_service = google.build_service
+
+    def tearDown(self):
+        google.query_google = self.query_google
+        google.build_service = self.build_service
+        db.session.remove()
+        db.drop_all()
+
+    def testTokenBucket(self):
+        """ Allows a burst of capacity calls, then rate calls a second """
+        bucket = google.TokenBucket(20, capacity=2)
+        taken = []
+        for i in xrange(6):
+            bucket.take()
+            taken.append(time.time())
+        # After the burst of two, each call waits for its own token
+        for a, b in zip(taken[1:], taken[2:]):
+            self.assertGreaterEqual(b - a, 0.04)
+        self.assertGreaterEqual(taken[-1] - taken[0], 0.18)
+
+    def testFetchRate(self):
+        """ Concurrent workers don't burst past the rate between them """
+        google.query_google = FakeQuery(latency=0)
+        for scores, fetch in google.fetch_batches(self.batched[:5], 4, 20):
+            pass
+        calls = sorted(google.query_google.calls)
+        self.assertGreaterEqual(calls[-1] - calls[0], 0.19)
+
+    def testConcurrentFetch(self):
+        """ Batches are fetched concurrently, up to the worker limit, and all written """
+        latency = 0.2
+        services = google.services
+        try:
+            with FakeTrends(latency) as server, environ(
+                    GOOGLE_API_ROOT=server.url, GOOGLE_API_KEY=os.environ.get('GOOGLE_API_KEY', 'test')):
+                google.services = google.ServicePool()
+                began = time.time()
+                for scores, fetch in google.fetch_batches(self.batched, 4, 1000):
+                    google.write_google_scores(scores, fetch)
+                elapsed = time.time() - began
+        finally:
+            google.services = services
+        self.assertEqual(server.requests, 8)
+        self.assertEqual(server.most_active, 4)
+        # Quicker than making the calls one after another
+        self.assertLess(elapsed, len(self.batched) * latency)
+        self.assertEqual(GoogleScore.query.count(), 80)
+
+        # One audit record per call
+        fetches = GoogleFetch.query.all()
+        self.assertEqual(len(fetches), 8)
+        self.assertEqual(len(set(f.batch_id for f in fetches)), 8)
+        self.assertEqual(set((f.status, f.retries, f.row_count, f.start_date, f.end_date) for f in fetches), set([(200, 0, 10, self.start, self.end)]))
+        self.assertTrue(all(f.latency >= 0.2 for f in fetches))
+        self.assertEqual(set(f.terms_hash for f in fetches), set(google.terms_hash([t.term]) for t in GoogleTerm.query))
+
+    def testRateLimited(self):
+        """ Workers share the rate limit """
+        google.query_google = fake = FakeQuery(latency=0)
+        list(google.fetch_batches(self.batched, 4, 20))
+        self.assertGreaterEqual(max(fake.calls) - min(fake.calls), 0.18)
+
+    def testRetries(self):
+        """ Failed batches back off and retry, and give up after the last attempt """
+        google.query_google = FakeQuery(latency=0, failures=2)
+        fetched = list(google.fetch_batches(self.batched, 4, 1000, backoff=0.05))
+        self.assertEqual(sorted(len(scores) for scores, fetch in fetched), [10] * 8)
+        self.assertEqual([fetch['retries'] for scores, fetch in fetched], [2] * 8)
+
+        google.query_google = FakeQuery(latency=0, failures=3)
+        with self.assertRaises(HttpError) as raised:
+            list(google.fetch_batches(self.batched, 4, 1000, attempts=3, backoff=0.05))
+        self.assertEqual(raised.exception.fetch['status'], 503)
+        self.assertEqual(raised.exception.fetch['retries'], 2)
+        self.assertEqual(raised.exception.fetch['row_count'], 0)
+
+    def testServicePool(self):
+        """ Clients are built from the bundled discovery document, reused, and only lent to one thread at a time """
+        os.environ.setdefault('GOOGLE_API_KEY', 'test')
+        response = json.dumps({'lines': [{'term': 'Term 1', 'points': [{'date': 'Jan 01 2018', 'value': 2.5}]}]})
+        built = []
+
+        def build_service():
+            service = self.build_service()
+            service._http = HttpMockSequence([({'status': '200'}, response)] * 2)
+            built.append(service)
+            return service
+
+        google.build_service = build_service
+        pool = google.ServicePool()
+        with pool.service() as first:
+            with pool.service() as second:
+                self.assertIsNot(first, second)
+        with pool.service() as again:
+            self.assertIn(again, built)
+        self.assertEqual(len(built), 2)
+
+        services, google.services = google.services, pool
+        try:
+            for i in xrange(2):
+                terms = [google.SearchTerm(1, 'Term 1')]
+                scores = list(google.parse_response(terms, google.query_google(terms, self.start, self.end)))
+                self.assertEqual(scores, [{'term_id': 1, 'day': self.start, 'value': 2.5}])
+        finally:
+            google.services = services
+        self.assertEqual(len(built), 2)
+
+    def testCacheAndReplay(self):
+        """ Cached responses are used instead of querying, and replays only use the cache """
+        path = tempfile.mkdtemp()
+        try:
+            cache = ResponseCache(path)
+            google.query_google = fake = FakeQuery(latency=0)
+            first = list(google.fetch_batches(self.batched, 4, 1000, cache=cache))
+            self.assertEqual(len(fake.calls), 8)
+
+            google.query_google = fake = FakeQuery(latency=0)
+            again = list(google.fetch_batches(self.batched, 4, 1000, cache=cache, replay=True))
+            self.assertEqual(fake.calls, [])
+            self.assertEqual(set(fetch for scores, fetch in again), set([None]))
+            self.assertEqual(sorted(scores for scores, fetch in again), sorted(scores for scores, fetch in first))
+
+            # Expired responses are only used when replaying
+            cache.ttl = -1
+            list(google.fetch_batches(self.batched[:1], 4, 1000, cache=cache, replay=True))
+            self.assertEqual(fake.calls, [])
+            list(google.fetch_batches(self.batched[:1], 4, 1000, cache=cache))
+            self.assertEqual(len(fake.calls), 1)
+
+            with self.assertRaises(FluDetectorError):
+                list(google.fetch_batches(self.batched, 4, 1000, cache=ResponseCache(os.path.join(path, 'empty')), replay=True))
+        finally:
+            shutil.rmtree(path)
+
+    def testCacheEviction(self):
+        """ Keys ignore the term order, and the least recently used responses are evicted first """
+        path = tempfile.mkdtemp()
+        try:
+            key = request_key(['b', 'a'], self.start, self.end, 'GB-ENG')
+            self.assertEqual(key, request_key(['a', 'b'], self.start, self.end, 'GB-ENG'))
+            self.assertNotEqual(key, request_key(['a', 'b'], self.start, self.end, 'GB-SCT'))
+
+            cache = ResponseCache(path, size=250)
+            response = {'lines': ['x' * 90]}
+            cache.put('first', response)
+            cache.put('second', response)
+            os.utime(cache.entry('first'), (time.time() - 10, time.time()))
+            self.assertEqual(cache.get('second'), response)
+            cache.put('third', response)
+            self.assertIsNone(cache.get('first'))
+            self.assertEqual(cache.get('second'), response)
+            self.assertEqual(cache.get('third'), response)
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
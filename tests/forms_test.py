@@ -18,8 +18,9 @@ You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
 from flask import Flask
-from fludetector.forms import GetScoresWebForm
-from fludetector.models import db, Model, ModelScore, GoogleScore
+from fludetector.forms import GetScoresApiForm, GetScoresWebForm
+from fludetector.models import db, model_summary, Model, ModelScore, GoogleScore
+from werkzeug.datastructures import MultiDict
 from dateutil.relativedelta import relativedelta
 import datetime
 import unittest
@@ -76,3 +77,25 @@ class FormsTest(unittest.TestCase):
         self.assertEqual(scores_form.start.__html__(), input_start)
         all_scores = scores_form.model_regions.data[0][0].scores.all()
         self.assertEqual(len(all_scores), 32)
+
+    def testGetScoresWebFormSummaries(self):
+        """ The dates default from the summaries it's given """
+        model = Model.query.get(1)
+        summaries = model_summary([model])
+        summaries[1].regions['e'] = summaries[1].regions['e']._replace(last_day=datetime.date(2018, 3, 10))
+        scores_form = GetScoresWebForm(None, model_regions=[(model, 'e')], summaries=summaries)
+        self.assertEqual(scores_form.start.data, datetime.date(2018, 2, 10))
+        self.assertEqual(scores_form.end.data, datetime.date(2018, 3, 10))
+
+    def testGetScoresApiForm(self):
+        """ The dates default from the model's latest score, and a model without any fails validation """
+        today = datetime.date.today()
+        scores_form = GetScoresApiForm(MultiDict({'model': '1', 'region': 'e'}))
+        self.assertTrue(scores_form.validate())
+        self.assertEqual(scores_form.start.data, today - datetime.timedelta(days=7))
+        self.assertEqual(scores_form.end.data, today + datetime.timedelta(days=7))
+
+        db.engine.execute('insert into model values (2, "Empty Model", "google", 1, "matlab_function,1")')
+        scores_form = GetScoresApiForm(MultiDict({'model': '2', 'region': 'e'}))
+        self.assertFalse(scores_form.validate())
+        self.assertIn('start', scores_form.errors)
@@ -18,9 +18,13 @@ You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
 from flask import Flask
-from fludetector.models import db, Model, ModelScore, GoogleScore
+from fludetector.cache import clear_scores, score_key, ScoreCache
+from fludetector.calculator import CalculatorType
+from fludetector.models import db, bulk_upsert, CachedModelScore, Model, ModelRun, ModelScore, GoogleScore
 from fludetector.sources import google
 import datetime
+import math
+import os
 import unittest
 
 
@@ -79,6 +83,23 @@ class GoogleTest(unittest.TestCase):
         self.assertEqual(min(model_missing), datetime.date.today() - datetime.timedelta(days=1))
         self.assertEqual(max(model_missing), datetime.date.today())
 
+    def testMissingGoogleScores(self):
+        """ Expect the exact (term, day) pairs missing, per term """
+        db.engine.execute('insert into google_term values (2, "Term 2")')
+        db.engine.execute('insert into model_google_terms values (1, 2)')
+        start_date = datetime.date.today() - datetime.timedelta(days=3)
+        db.engine.execute('insert into google_score values (?, 1.0, 2)', start_date + datetime.timedelta(days=2))
+        model = db.session.query(Model).first()
+        term1, term2 = model.google_terms.all()
+        missing = google.missing_google_scores(model, start_date, datetime.date.today())
+        self.assertEqual(missing, [
+            (term1, datetime.date.today() - datetime.timedelta(days=1)),
+            (term1, datetime.date.today()),
+            (term2, start_date),
+            (term2, start_date + datetime.timedelta(days=1)),
+            (term2, datetime.date.today())])
+        self.assertEqual(google.missing_google_scores(model, datetime.date.today(), start_date), [])
+
     def testBatches(self):
         """ Expect one batch (batches of up to 30 terms) """
         model = db.session.query(Model).first()
@@ -90,3 +111,185 @@ class GoogleTest(unittest.TestCase):
         self.assertEqual(b[1], start_date)
         self.assertEqual(b[2], end_date)
 
+    def testPlan(self):
+        """ Terms are only queried over the spans they're missing, in as few calls as the limits allow """
+        model = db.session.query(Model).first()
+        end = datetime.date.today()
+        start = end - datetime.timedelta(days=199)
+        for i in xrange(2, 61):
+            db.engine.execute('insert into google_term values (?, ?)', i, 'Term %d' % i)
+            db.engine.execute('insert into model_google_terms values (1, ?)', i)
+        # Terms 2-30 are new, the others have everything but the last 2 days
+        bulk_upsert(GoogleScore, [
+            {'term_id': i, 'day': start + datetime.timedelta(days=d), 'value': 1.0}
+            for i in [1] + range(31, 61) for d in xrange(-1, 198)])
+        db.session.commit()
+
+        calls = google.plan(model, start, end)
+        self.assertEqual(len(calls), 5)
+        self.assertLess(len(calls), len(list(google.batches(model, start - datetime.timedelta(days=1), end))))
+        covered = set()
+        for terms, s, e in calls:
+            self.assertLessEqual(len(terms), google.MAX_TERMS)
+            self.assertLessEqual(len(terms) * ((e - s).days + 1), google.MAX_POINTS)
+            for t in terms:
+                if t.id == 1 or t.id > 30:
+                    self.assertEqual((s, e), (end - datetime.timedelta(days=2), end))
+                covered.update((t, s + datetime.timedelta(days=d)) for d in xrange((e - s).days + 1))
+        self.assertTrue(set(google.missing_google_scores(model, start, end)) <= covered)
+
+        # Nothing to plan once everything's there
+        bulk_upsert(GoogleScore, [
+            {'term_id': t.id, 'day': day, 'value': 1.0} for terms, s, e in calls for t in terms
+            for day in (s + datetime.timedelta(days=d) for d in xrange((e - s).days + 1))])
+        self.assertEqual(google.plan(model, start, end), [])
+
+    def testRunCheckpoints(self):
+        """ Runs commit a chunk at a time, and failed runs resume after the last chunk committed """
+        db.engine.execute('insert into google_term values (2, "Term 2")')
+        db.engine.execute('insert into model_google_terms values (1, 2)')
+        model = db.session.query(Model).first()
+        start = datetime.date(2018, 1, 1)
+        end = datetime.date(2018, 1, 20)
+        queried = []
+        failing = [True]
+
+        def query_google(terms, s, e):
+            queried.append((s, e))
+            days = [s + datetime.timedelta(days=i) for i in xrange((e - s).days + 1)]
+            return {'lines': [
+                {'term': t.term, 'points': [{'date': d.strftime('%b %d %Y'), 'value': d.day} for d in days]}
+                for t in terms]}
+
+        class Calculator(object):
+            conf = None
+
+            def calculateModelScore(self, model, averages):
+                # Every term's average is the day of the month
+                if failing and averages[0][1] == 12:
+                    raise ValueError('Engine failed')
+                return sum(v for t, v in averages)
+
+        original = google.query_google, google.buildCalculator
+        google.query_google = query_google
+        google.buildCalculator = lambda conf: Calculator()
+        os.environ['RUN_CHUNK_DAYS'] = '5'
+        os.environ.setdefault('TWITTER_ENABLED', 'False')
+        try:
+            with self.assertRaises(ValueError):
+                google.run(model, start, end)
+            model_run = ModelRun.query.one()
+            self.assertEqual(model_run.status, 'failed')
+            self.assertEqual(model_run.completed, datetime.date(2018, 1, 10))
+            self.assertEqual(model_run.resume_from, datetime.date(2018, 1, 11))
+            self.assertEqual(model.scores.filter(ModelScore.day <= end).count(), 10)
+            # Planned once for the whole run, so the lookback is only fetched once
+            self.assertEqual(queried, [(start - datetime.timedelta(days=1), end)])
+
+            del failing[:]
+            del queried[:]
+            google.run(model, start, end, resume=model_run)
+            self.assertEqual(ModelRun.query.one().status, 'complete')
+            self.assertEqual(queried, [])
+            scores = model.scores.filter(ModelScore.day <= end).order_by(ModelScore.day).all()
+            self.assertEqual([s.day for s in scores], [start + datetime.timedelta(days=i) for i in xrange(20)])
+            self.assertEqual(scores[-1].value, 40)
+        finally:
+            google.query_google, google.buildCalculator = original
+            del os.environ['RUN_CHUNK_DAYS']
+
+    def testNothingToRun(self):
+        """ No ModelRun is started when every score is already there """
+        model = db.session.query(Model).first()
+        start = datetime.date.today() - datetime.timedelta(days=4)
+        google.run(model, start, start + datetime.timedelta(days=2))
+        self.assertEqual(ModelRun.query.count(), 0)
+
+    def testScoreCache(self):
+        """ Values are only calculated once for the same function, version and averages """
+        model = db.session.query(Model).first()
+        start = datetime.date.today() - datetime.timedelta(days=5)
+        end = start + datetime.timedelta(days=3)
+        calls = []
+
+        class Calculator(object):
+            conf = None
+
+            def calculateModelScore(self, model, averages):
+                calls.append(averages)
+                return averages[0][1] * 2
+
+        def calculate():
+            scores = list(google.calculate_model_scores(model, start, end, Calculator()))
+            db.session.commit()
+            return [s['value'] for s in scores]
+
+        os.environ['SCORE_CACHE_SIZE'] = '6'
+        try:
+            self.assertEqual(calculate(), [13, 11, 9, 7])
+            self.assertEqual(len(calls), 4)
+            self.assertEqual(calculate(), [13, 11, 9, 7])
+            self.assertEqual(len(calls), 4)
+
+            os.environ['SCORE_CACHE_VERSION'] = '2'
+            self.assertEqual(calculate(), [13, 11, 9, 7])
+            self.assertEqual(len(calls), 8)
+            # The least recently used, from version 1, are evicted
+            self.assertEqual(CachedModelScore.query.count(), 6)
+            self.assertEqual(calculate(), [13, 11, 9, 7])
+            self.assertEqual(len(calls), 8)
+
+            self.assertEqual(clear_scores('matlab_function'), 6)
+            self.assertEqual(calculate(), [13, 11, 9, 7])
+            self.assertEqual(len(calls), 12)
+
+            # Values are shared between engines
+            Calculator.conf = CalculatorType.REMOTE
+            self.assertEqual(calculate(), [13, 11, 9, 7])
+            self.assertEqual(len(calls), 12)
+        finally:
+            del os.environ['SCORE_CACHE_SIZE']
+            os.environ.pop('SCORE_CACHE_VERSION', None)
+
+    def testScoreCacheEviction(self):
+        """ The size is checked on the first write, then once a tenth more have been written """
+        cache = ScoreCache(20)
+        counts = []
+        for i in xrange(30):
+            cache.put_many('f', {score_key('f', [('flu', float(i))]): float(i)})
+            counts.append(CachedModelScore.query.count())
+        self.assertEqual(counts[:3], [1, 2, 3])
+        self.assertEqual(counts[19:], [20, 20, 21, 20, 21, 20, 21, 20, 21, 20, 21])
+
+    def testMovingAverageMatrix(self):
+        """ Matches calculate_moving_average for every term and day, including missing windows """
+        db.engine.execute('update model set data = "matlab_function,3"')
+        db.engine.execute('insert into google_term values (2, "Term 2")')
+        db.engine.execute('insert into model_google_terms values (1, 2)')
+        start_date = datetime.date.today() - datetime.timedelta(days=12)
+        for i in xrange(12):
+            if i in (4, 8):
+                continue
+            gs = GoogleScore()
+            gs.day = start_date + datetime.timedelta(days=i)
+            gs.value = i * 1.1
+            gs.term_id = 2
+            db.session.add(gs)
+        db.session.commit()
+        model = db.session.query(Model).first()
+        start = start_date + datetime.timedelta(days=1)
+        end = datetime.date.today()
+        terms, days, averages = google.moving_average_matrix(model, start, end)
+        self.assertEqual([t.term for t in terms], ['Term 1', 'Term 2'])
+        self.assertEqual(days[0], start)
+        self.assertEqual(days[-1], end)
+        for t, term in enumerate(terms):
+            for d, day in enumerate(days):
+                expected = google.calculate_moving_average(term, day, 3)
+                if expected is None:
+                    self.assertTrue(math.isnan(averages[d, t]))
+                else:
+                    self.assertAlmostEqual(averages[d, t], expected)
+        self.assertEqual(
+            google.calculate_moving_averages(model, start_date + datetime.timedelta(days=3)),
+            [('Term 2', 2.2)])
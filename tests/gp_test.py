@@ -0,0 +1,120 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from fludetector.calculator import LocalNative
+from fludetector.errors import FluDetectorError
+from fludetector.gp import GaussianProcess
+import json
+import math
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FakeModel(object):
+
+    def get_data(self):
+        return {'matlab_function': 'flu_gp'}
+
+
+def reference_mean(X, y, x, ells, sf, sn, mean):
+    """GPML's predictive mean, the slow way"""
+    def k(a, b):
+        return sf ** 2 * math.exp(-sum(((ai - bi) / ell) ** 2 for ai, bi, ell in zip(a, b, ells)) / 2)
+    K = np.array([[k(a, b) for b in X] for a in X]) + sn ** 2 * np.eye(len(X))
+    ks = np.array([k(x, b) for b in X])
+    return mean + ks.dot(np.linalg.solve(K, np.asarray(y) - mean))
+
+
+class GaussianProcessTest(unittest.TestCase):
+
+    X = [[0.1, 1.0, 0.5], [0.4, 0.8, 0.2], [0.9, 0.3, 0.7], [0.2, 0.6, 0.9], [0.7, 0.1, 0.4]]
+    y = [1.2, 0.7, 2.5, 1.9, 1.1]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testSinglePoint(self):
+        """ With one training point, the mean there is shrunk by sf^2 / (sf^2 + sn^2) """
+        gp = GaussianProcess(['flu'], [[1.0]], [3.0], [{'type': 'SEiso', 'hyp': [0.0, math.log(2)]}], math.log(1))
+        self.assertAlmostEqual(gp.predict([[1.0]])[0], 3.0 * 4 / 5)
+
+    def testSEiso(self):
+        gp = GaussianProcess(['a', 'b', 'c'], self.X, self.y, [
+            {'type': 'SEiso', 'hyp': [math.log(0.5), math.log(1.5)]}], math.log(0.1), mean=1.0)
+        days = [[0.3, 0.5, 0.5], [0.9, 0.3, 0.7], [0.0, 0.0, 0.0]]
+        expected = [reference_mean(self.X, self.y, x, [0.5] * 3, 1.5, 0.1, 1.0) for x in days]
+        np.testing.assert_allclose(gp.predict(days), expected)
+
+    def testSEardSum(self):
+        """ Summed kernels, each over some of the terms """
+        gp = GaussianProcess(['a', 'b', 'c'], self.X, self.y, [
+            {'type': 'SEard', 'hyp': [math.log(0.3), math.log(0.7), math.log(1.1)], 'mask': [0, 1]},
+            {'type': 'SEiso', 'hyp': [math.log(0.4), math.log(0.5)], 'mask': [2]}], math.log(0.2))
+        x = [0.3, 0.5, 0.5]
+
+        def k(a, b):
+            return (1.1 ** 2 * math.exp(-(((a[0] - b[0]) / 0.3) ** 2 + ((a[1] - b[1]) / 0.7) ** 2) / 2) +
+                    0.5 ** 2 * math.exp(-((a[2] - b[2]) / 0.4) ** 2 / 2))
+        K = np.array([[k(a, b) for b in self.X] for a in self.X]) + 0.2 ** 2 * np.eye(5)
+        expected = np.array([k(x, b) for b in self.X]).dot(np.linalg.solve(K, self.y))
+        self.assertAlmostEqual(gp.predict([x])[0], expected)
+
+    def testBadModels(self):
+        with self.assertRaises(FluDetectorError):
+            GaussianProcess(['a', 'b', 'c'], self.X, self.y, [{'type': 'Matern', 'hyp': [0, 0]}], 0)
+        with self.assertRaises(FluDetectorError):
+            GaussianProcess(['a', 'b'], self.X, self.y, [{'type': 'SEiso', 'hyp': [0, 0]}], 0)
+        with self.assertRaises(FluDetectorError):
+            GaussianProcess(['a', 'b', 'c'], self.X, self.y, [{'type': 'SEard', 'hyp': [0, 0]}], 0).predict(self.X)
+
+    def testLocalNative(self):
+        """ Loads the exported model named after the matlab_function, and scores days in order """
+        with open(os.path.join(self.path, 'flu_gp.json'), 'w') as fh:
+            json.dump({
+                'terms': ['a', 'b', 'c'], 'X': self.X, 'y': self.y, 'mean': 1.0, 'lik': math.log(0.1),
+                'cov': [{'type': 'SEiso', 'hyp': [math.log(0.5), math.log(1.5)]}]}, fh)
+        os.environ['NATIVE_MODELS_PATH'] = self.path
+        try:
+            calculator = LocalNative()
+        finally:
+            del os.environ['NATIVE_MODELS_PATH']
+        scores = calculator.calculateModelScores(FakeModel(), [
+            [('a', 0.3), ('b', 0.5), ('c', 0.5)],
+            [('c', 0.7), ('a', 0.9), ('b', 0.3), ('unknown', 5.0)],
+            [('b', 0.5)]])
+        expected = [reference_mean(self.X, self.y, x, [0.5] * 3, 1.5, 0.1, 1.0)
+                    for x in ([0.3, 0.5, 0.5], [0.9, 0.3, 0.7], [0, 0.5, 0])]
+        np.testing.assert_allclose(scores, expected)
+        self.assertAlmostEqual(calculator.calculateModelScore(FakeModel(), [('b', 0.5)]), expected[2])
+
+        class Missing(object):
+            def get_data(self):
+                return {'matlab_function': 'missing'}
+        with self.assertRaises(FluDetectorError):
+            calculator.calculateModelScore(Missing(), [('a', 1.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
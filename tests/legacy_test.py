@@ -0,0 +1,115 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from fludetector.calculator import LegacyMatlab
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Runs the command it's given locally, ignoring the options and host
+SSH = """#!%s
+import subprocess, sys
+args = sys.argv[1:]
+while args[0] == '-o':
+    args = args[2:]
+with open(%r, 'a') as log:
+    log.write(' '.join(args[1:]) + '\\n')
+sys.exit(subprocess.call(' '.join(args[1:]), shell=True))
+"""
+
+# Scores each day as the sum of its averages, or fails for the function fail
+MATLAB = """#!%s
+import math, re, sys
+call = re.search(r"fludetector_scores\\('(\\w+)','([^']+)','([^']+)'\\)", sys.argv[-1])
+function, fin, fout = call.groups()
+if function == 'fail':
+    sys.exit(1)
+lines = open(fin).read().splitlines()[1:]
+scores = [sum(v for v in map(float, line.split(',')) if not math.isnan(v)) for line in lines]
+open(fout, 'w').write(''.join('%%r\\n' %% s for s in scores))
+"""
+
+
+class FakeModel(object):
+
+    def __init__(self, function):
+        self.function = function
+
+    def get_data(self):
+        return {'matlab_function': self.function}
+
+
+class LegacyMatlabTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log = os.path.join(self.path, 'ssh.log')
+        for name, script in (('ssh', SSH % (sys.executable, self.log)), ('matlab', MATLAB % sys.executable)):
+            with open(os.path.join(self.path, name), 'w') as fh:
+                fh.write(script)
+            os.chmod(os.path.join(self.path, name), 0o755)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = '%s:%s' % (self.path, os.environ['PATH'])
+        os.environ['LEGACY_SSH'] = os.path.join(self.path, 'ssh')
+        self.remotes = set(glob.glob('/tmp/fludetector-*'))
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def commands(self):
+        with open(self.log) as fh:
+            return [line.split()[0] for line in fh]
+
+    def testBatch(self):
+        """ Uploads, runs Matlab and reads back once for all the days, then cleans up """
+        calculator = LegacyMatlab()
+        days = [[('flu', 0.1), ('cough', 2.0)], [('cough', 3.0)], [('fever', 1.25), ('flu', 1.0)]]
+        self.assertEqual(calculator.calculateModelScores(FakeModel('flu_model'), days), [2.1, 3.0, 2.25])
+        self.assertEqual(self.commands(), ['mkdir', 'matlab', 'cat', 'rm'])
+        self.assertEqual(set(glob.glob('/tmp/fludetector-*')), self.remotes)
+
+    def testFailure(self):
+        """ Matlab failing is an error, and is cleaned up after too """
+        with self.assertRaises(Exception):
+            LegacyMatlab().calculateModelScore(FakeModel('fail'), [('flu', 1.0)])
+        self.assertEqual(self.commands(), ['mkdir', 'matlab', 'rm'])
+        self.assertEqual(set(glob.glob('/tmp/fludetector-*')), self.remotes)
+
+    def testCleanupFailure(self):
+        """ Failing to clean up doesn't hide why Matlab failed """
+        with open(os.path.join(self.path, 'rm'), 'w') as fh:
+            fh.write('#!/bin/sh\nexit 1\n')
+        os.chmod(os.path.join(self.path, 'rm'), 0o755)
+        try:
+            with self.assertRaises(Exception) as raised:
+                LegacyMatlab().calculateModelScore(FakeModel('fail'), [('flu', 1.0)])
+            self.assertIn('matlab', str(raised.exception))
+            self.assertEqual(self.commands(), ['mkdir', 'matlab', 'rm'])
+        finally:
+            for remote in set(glob.glob('/tmp/fludetector-*')) - self.remotes:
+                shutil.rmtree(remote)
+
+
+if __name__ == '__main__':
+    unittest.main()
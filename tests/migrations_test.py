@@ -0,0 +1,82 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+import datetime
+import imp
+import os
+import sqlalchemy as sa
+import unittest
+
+VERSIONS = os.path.join(os.path.dirname(__file__), '..', 'migrations', 'versions')
+
+
+def load(name):
+    return imp.load_source(name.split('_')[1], os.path.join(VERSIONS, name))
+
+
+class GoogleFetchMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = sa.create_engine('sqlite://')
+        self.engine.execute(
+            'CREATE TABLE google_log (id INTEGER PRIMARY KEY, score_timestamp DATETIME NOT NULL, '
+            'score_date DATE NOT NULL)')
+        self.migration = load('2026-10-18_f24dae0ddf6d_google_fetch_audit.py')
+
+    def log(self, start, first, days, terms):
+        """Log scores the way run_batch did, each with its own timestamp"""
+        timestamp = start
+        for t in xrange(terms):
+            for d in xrange(days):
+                timestamp += datetime.timedelta(microseconds=250)
+                self.engine.execute(
+                    'INSERT INTO google_log (score_timestamp, score_date) VALUES (?, ?)',
+                    str(timestamp), str(first + datetime.timedelta(days=d)))
+
+    def testUpgradeCompactsRuns(self):
+        """ A run's rows, with distinct timestamps, become one google_fetch row """
+        self.log(datetime.datetime(2018, 1, 10, 3, 0), datetime.date(2018, 1, 1), 7, 3)
+        # A second batch of the same run, a few seconds later
+        self.log(datetime.datetime(2018, 1, 10, 3, 0, 5), datetime.date(2018, 1, 3), 2, 2)
+        self.log(datetime.datetime(2018, 1, 11, 3, 0), datetime.date(2018, 1, 8), 1, 3)
+
+        with self.engine.connect() as conn:
+            with Operations.context(MigrationContext.configure(conn)):
+                self.migration.upgrade()
+            self.assertNotIn('google_log', sa.inspect(conn).get_table_names())
+            fetches = conn.execute(
+                'SELECT start_date, end_date, status, row_count FROM google_fetch ORDER BY id').fetchall()
+        self.assertEqual(fetches, [('2018-01-01', '2018-01-07', 200, 25), ('2018-01-08', '2018-01-08', 200, 3)])
+
+
+    def testUpgradeInChunks(self):
+        """ The google_fetch rows are written a chunk at a time """
+        self.migration.CHUNK_SIZE = 1
+        for day in xrange(5):
+            self.log(datetime.datetime(2018, 1, 10 + day), datetime.date(2018, 1, 1 + day), 1, 2)
+        with self.engine.connect() as conn:
+            with Operations.context(MigrationContext.configure(conn)):
+                self.migration.upgrade()
+            fetches = conn.execute('SELECT start_date, row_count FROM google_fetch ORDER BY id').fetchall()
+        self.assertEqual(fetches, [('2018-01-0%d' % (day + 1), 2) for day in xrange(5)])
+
+if __name__ == '__main__':
+    unittest.main()
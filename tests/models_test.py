@@ -18,10 +18,14 @@ You should have received a copy of the GNU General Public License
 along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
 """
 from flask import Flask
-from fludetector.models import GoogleLog, Model, ModelScore, db
-from sqlalchemy.exc import IntegrityError
+from fludetector import models
+from fludetector.models import GoogleFetch, GoogleScore, Model, ModelScore, RegionSummary, bulk_upsert, db, model_summary
+from sqlalchemy.exc import IntegrityError, OperationalError
 import unittest
 import datetime
+import os
+import shutil
+import tempfile
 
 
 class ModelsTest(unittest.TestCase):
@@ -43,33 +47,41 @@ class ModelsTest(unittest.TestCase):
         db.session.remove()
         db.drop_all()
 
-    def testGoogleLog(self):
-        """ Creates and persists a valid GoogleLog instance """
-        gl = GoogleLog()
-        gl.score_date = datetime.date.today()
-        gl.score_timestamp = datetime.datetime.utcnow()
-        expected = gl.__repr__()
-        db.session.add(gl)
+    def testGoogleFetch(self):
+        """ Creates and persists a valid GoogleFetch instance """
+        gf = GoogleFetch()
+        gf.batch_id = 'abc123'
+        gf.start_date = datetime.date.today() - datetime.timedelta(days=3)
+        gf.end_date = datetime.date.today()
+        gf.timestamp = datetime.datetime.utcnow()
+        gf.status = 200
+        gf.row_count = 4
+        expected = gf.__repr__()
+        db.session.add(gf)
         db.session.commit()
-        gls = GoogleLog.query.all()
-        self.assertIn(gl, gls)
-        self.assertEquals(str(gls[0]), expected)
-
-    def testGoogleLogNullDate(self):
-        """ Attempts to persist an invalid GoogleLog instance when score_date is None """
-        gl = GoogleLog()
-        gl.score_timestamp = datetime.datetime.utcnow()
-        self.assertIsNone(gl.score_date)
-        db.session.add(gl)
+        gfs = GoogleFetch.query.all()
+        self.assertIn(gf, gfs)
+        self.assertEquals(str(gfs[0]), expected)
+
+    def testGoogleFetchNullDate(self):
+        """ Attempts to persist an invalid GoogleFetch instance when start_date is None """
+        gf = GoogleFetch()
+        gf.end_date = datetime.date.today()
+        gf.timestamp = datetime.datetime.utcnow()
+        gf.row_count = 0
+        self.assertIsNone(gf.start_date)
+        db.session.add(gf)
         with self.assertRaises(IntegrityError):
             db.session.commit()
 
-    def testGoogleLogNullTimestamp(self):
-        """ Attempts to persist an invalid GoogleLog instance when score_timestamp is None """
-        gl = GoogleLog()
-        gl.score_date = datetime.date.today()
-        self.assertIsNone(gl.score_timestamp)
-        db.session.add(gl)
+    def testGoogleFetchNullTimestamp(self):
+        """ Attempts to persist an invalid GoogleFetch instance when timestamp is None """
+        gf = GoogleFetch()
+        gf.start_date = datetime.date.today()
+        gf.end_date = datetime.date.today()
+        gf.row_count = 0
+        self.assertIsNone(gf.timestamp)
+        db.session.add(gf)
         with self.assertRaises(IntegrityError):
             db.session.commit()
 
@@ -101,6 +113,161 @@ class ModelsTest(unittest.TestCase):
         self.assertEqual(result_get_data['matlab_function'], 'matlab_function')
         self.assertEqual(result_get_data['average_window_size'], 1)
 
+    def testModelSummary(self):
+        """ Summarises regions, date spans and counts without loading scores """
+        db.engine.execute('insert into model values (1, "Model 1", "google", 1, "matlab_function,1")')
+        db.engine.execute('insert into model values (2, "Model 2", "csv", 1, NULL)')
+        db.engine.execute('insert into model values (3, "Model 3", "csv", 1, NULL)')
+        day = datetime.date(2018, 1, 1)
+        for model_id, region, days in [(1, 'e', 10), (1, 'l', 3), (2, 'e', 5)]:
+            for i in xrange(days):
+                ms = ModelScore()
+                ms.day = day + datetime.timedelta(days=i)
+                ms.region = region
+                ms.value = 1.0
+                ms.model_id = model_id
+                db.session.add(ms)
+        db.session.commit()
+        summaries = model_summary()
+        self.assertEqual(summaries[1].region_codes, ['e', 'l'])
+        self.assertEqual(summaries[1].regions['l'], RegionSummary(day, day + datetime.timedelta(days=2), 3))
+        self.assertEqual(summaries[1].first_day, day)
+        self.assertEqual(summaries[1].last_day, day + datetime.timedelta(days=9))
+        self.assertEqual(summaries[1].count, 13)
+        self.assertEqual(summaries[2].count, 5)
+        self.assertEqual(summaries[3].count, 0)
+        self.assertIsNone(summaries[3].last_day)
+        model = Model.query.get(1)
+        self.assertEqual([r['code'] for r in model.regions], ['e', 'l'])
+        self.assertEqual(model_summary([model]).keys(), [1])
+
+    def testGetScoresResolutions(self):
+        """ Weekly scores are Sundays, and weekly and monthly means are averaged by the database """
+        db.engine.execute('insert into model values (1, "Test Model", "google", 1, "matlab_function,1")')
+        day = datetime.date(2018, 1, 1)  # A Monday
+        for i in xrange(62):
+            ms = ModelScore()
+            ms.day = day + datetime.timedelta(days=i)
+            ms.region = 'e'
+            ms.value = float(i)
+            ms.model_id = 1
+            db.session.add(ms)
+        db.session.commit()
+        model = db.session.query(Model).first()
+        end = day + datetime.timedelta(days=61)
+
+        weekly = model.get_scores(day, end, 'e', 'week')
+        self.assertEqual([s.day.weekday() for s in weekly], [6] * 8)
+        self.assertEqual(weekly[0].day, datetime.date(2018, 1, 7))
+
+        week_means = model.get_scores(day, end, 'e', 'week_mean')
+        self.assertEqual(len(week_means), 9)
+        self.assertEqual(week_means[0].day, datetime.date(2018, 1, 7))
+        self.assertEqual(week_means[0].value, 3.0)
+        self.assertEqual(week_means[-1].day, datetime.date(2018, 3, 4))
+        self.assertEqual(week_means[-1].value, 58.5)
+        self.assertEqual(week_means[0].model, model)
+
+        month_means = model.get_smoothed_scores(day, end, 'e', 'month_mean', 7)
+        self.assertEqual([(s.day, v) for s, v in month_means], [
+            (datetime.date(2018, 1, 1), 15.0),
+            (datetime.date(2018, 2, 1), 44.5),
+            (datetime.date(2018, 3, 1), 60.0)])
+
+    def testBulkUpsert(self):
+        """ Inserts new rows and replaces existing ones in chunks """
+        day = datetime.date(2018, 1, 1)
+        db.engine.execute('insert into google_score values ("2018-01-02", 5.0, 1)')
+        rows = [
+            {'term_id': term_id, 'day': day + datetime.timedelta(days=i), 'value': float(i)}
+            for term_id in (1, 2) for i in xrange(5)]
+        self.assertEqual(bulk_upsert(GoogleScore, iter(rows), chunk_size=3), 10)
+        db.session.commit()
+        self.assertEqual(GoogleScore.query.count(), 10)
+        self.assertEqual(GoogleScore.query.filter_by(term_id=1, day=day + datetime.timedelta(days=1)).one().value, 1.0)
+        self.assertEqual(bulk_upsert(GoogleScore, []), 0)
+
+    def testGetSmoothedScores(self):
+        """ Smoothed scores match ModelScore.smoothed, including around gaps and at the edges """
+        db.engine.execute('insert into model values (1, "Test Model", "google", 1, "matlab_function,1")')
+        day = datetime.date(2018, 1, 1)
+        for i in xrange(30):
+            if i in (10, 11, 20):
+                continue
+            ms = ModelScore()
+            ms.day = day + datetime.timedelta(days=i)
+            ms.region = 'e'
+            ms.value = float(i * i % 7)
+            ms.model_id = 1
+            db.session.add(ms)
+        db.session.commit()
+        model = db.session.query(Model).first()
+        start = day + datetime.timedelta(days=2)
+        end = day + datetime.timedelta(days=27)
+        for smoothing in (0, 3, 5, 7):
+            for resolution in ('day', 'week'):
+                smoothed = model.get_smoothed_scores(start, end, 'e', resolution, smoothing)
+                self.assertEqual([s for s, v in smoothed], model.get_scores(start, end, 'e', resolution))
+                for s, value in smoothed:
+                    self.assertAlmostEqual(value, s.smoothed(smoothing))
+
+
+class SqliteConcurrencyTest(unittest.TestCase):
+
+    @staticmethod
+    def create_app(path, **config):
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % os.path.join(path, 'data.db')
+        app.config['SQLITE_BUSY_TIMEOUT'] = 100
+        app.config.update(config)
+        models.init_app(app)
+        app.app_context().push()
+        return app
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.path)
+
+    def read_during_write(self):
+        """Hold a write transaction open, like a long model run, and read while it's open"""
+        db.create_all()
+        db.engine.execute('insert into model values (1, "Test Model", "csv", 1, NULL)')
+        writer = db.engine.raw_connection()
+        writer.connection.isolation_level = None  # Manage the transaction ourselves
+        cursor = writer.cursor()
+        try:
+            cursor.execute('BEGIN EXCLUSIVE')
+            cursor.execute('insert into model_score values ("2018-01-01", "e", 1.0, 1)')
+            return db.engine.execute('select count(*) from model').scalar()
+        finally:
+            cursor.execute('COMMIT')
+            writer.close()
+
+    def testPragmas(self):
+        """ Every connection gets the configured pragmas """
+        SqliteConcurrencyTest.create_app(self.path, SQLALCHEMY_POOL_SIZE='2')
+        self.assertEqual(db.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.engine.execute('PRAGMA synchronous').scalar(), 1)
+        self.assertEqual(db.engine.execute('PRAGMA busy_timeout').scalar(), 100)
+        self.assertEqual(db.engine.execute('PRAGMA cache_size').scalar(), -65536)
+        self.assertEqual(db.engine.pool.size(), 2)
+
+    def testReadersNotBlockedByWriter(self):
+        """ Readers can read while a writer has an exclusive transaction open """
+        SqliteConcurrencyTest.create_app(self.path)
+        self.assertEqual(self.read_during_write(), 1)
+
+    def testReadersBlockedWithoutWal(self):
+        """ Without WAL the same read fails, so the test above means something """
+        SqliteConcurrencyTest.create_app(self.path, SQLITE_JOURNAL_MODE='DELETE')
+        with self.assertRaises(OperationalError):
+            self.read_during_write()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,118 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from flask import Flask
+from sqlalchemy import event
+from fludetector.models import db, Model, GoogleTerm, TwitterNgram, TwitterScore
+from fludetector.sources import google
+import datetime
+import unittest
+
+SCORE_TABLES = ['model_score', 'google_score', 'twitter_score']
+
+
+class QueryPlanTest(unittest.TestCase):
+    """Checks that the hot time-series queries search an index rather than
+    scanning a whole score table"""
+
+    @staticmethod
+    def create_app():
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.app_context().push()
+        return app
+
+    def setUp(self):
+        db.init_app(QueryPlanTest.create_app())
+        db.create_all()
+        db.engine.execute('insert into model values (1, "Test Model", "google", 1, "matlab_function,7")')
+        db.engine.execute('insert into google_term values (1, "Term 1")')
+        db.engine.execute('insert into model_google_terms values (1, 1)')
+        db.engine.execute('insert into twitter_ngram values (1, "ngram", "e")')
+        db.engine.execute('insert into model_twitter_ngrams values (1, 1)')
+        db.engine.execute('insert into model_score values ("2018-01-01", "e", 1.0, 1)')
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def capture(self, func):
+        """Run func and return the SELECTs it sent to the database"""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertTrue(statements)
+        return statements
+
+    def assertUsesIndexes(self, func):
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for statement, parameters in self.capture(func):
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    for table in SCORE_TABLES:
+                        self.assertFalse(
+                            detail.startswith('SCAN') and table in detail.split(),
+                            'Full scan of %s in: %s' % (table, statement))
+        finally:
+            connection.close()
+
+    def testModelScoreQueries(self):
+        model = Model.query.get(1)
+        start = datetime.date(2018, 1, 1)
+        end = datetime.date(2018, 2, 1)
+        self.assertUsesIndexes(lambda: model.get_scores(start, end, 'e', 'day'))
+        self.assertUsesIndexes(lambda: model.get_smoothed_scores(start, end, 'e', 'day', 7))
+        self.assertUsesIndexes(lambda: model.scores.first().smoothed(7))
+        self.assertUsesIndexes(lambda: model.first_score)
+        self.assertUsesIndexes(lambda: model.last_score)
+        self.assertUsesIndexes(lambda: model.summary)
+        self.assertUsesIndexes(lambda: list(google.days_missing_model_score(model, start, end)))
+
+    def testGoogleScoreQueries(self):
+        model = Model.query.get(1)
+        term = GoogleTerm.query.get(1)
+        start = datetime.date(2018, 1, 1)
+        end = datetime.date(2018, 2, 1)
+        self.assertUsesIndexes(lambda: google.calculate_moving_average(term, end, 7))
+        self.assertUsesIndexes(lambda: list(google.days_missing_google_score(model, start, end)))
+
+    def testTwitterScoreQueries(self):
+        ngram = TwitterNgram.query.get(1)
+        start = datetime.date(2018, 1, 1)
+        end = datetime.date(2018, 2, 1)
+        self.assertUsesIndexes(lambda: ngram.scores.all())
+        self.assertUsesIndexes(lambda: ngram.scores.filter(TwitterScore.day >= start, TwitterScore.day < end).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+"""
+Fludetector: website, REST API, and data processors for the Fludetector service from UCL.
+(c) 2019, UCL <https://www.ucl.ac.uk/
+
+This file is part of Fludetector
+
+Fludetector is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Fludetector is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Fludetector.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from flask import Flask
+from fludetector.models import db, Model, ModelScore, StoredScore, refresh_score_store, rebuild_score_store
+from fludetector.store import ScoreStore
+import datetime
+import shutil
+import tempfile
+import unittest
+
+
+class StoreTest(unittest.TestCase):
+
+    @staticmethod
+    def create_app(store_path):
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['SCORE_STORE_PATH'] = store_path
+        app.app_context().push()
+        return app
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.app = StoreTest.create_app(self.path)
+        db.init_app(self.app)
+        db.create_all()
+        db.engine.execute('insert into model values (1, "Test Model", "google", 1, "matlab_function,1")')
+        self.day = datetime.date(2018, 1, 1)
+        for i in xrange(40):
+            if i % 9 == 4:
+                continue
+            ms = ModelScore()
+            ms.day = self.day + datetime.timedelta(days=i)
+            ms.region = 'e'
+            ms.value = i / 3.0
+            ms.model_id = 1
+            db.session.add(ms)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.path)
+
+    def testReadWrite(self):
+        """ Only the days that were written are read back, including across bitmap bytes """
+        store = ScoreStore(self.path)
+        self.assertIsNone(store.read(1, 'e', self.day, self.day))
+        days = [self.day + datetime.timedelta(days=i) for i in (0, 3, 7, 8, 15)]
+        store.write(1, 'e', days, [1.0, 2.0, 3.0, 4.0, 5.0])
+        read_days, values = store.read(1, 'e', self.day + datetime.timedelta(days=1), self.day + datetime.timedelta(days=30))
+        self.assertEqual(read_days, days[1:])
+        self.assertEqual(list(values), [2.0, 3.0, 4.0, 5.0])
+
+        # Writes are incremental, and grow the files
+        store.write(1, 'e', [self.day, self.day + datetime.timedelta(days=100)], [10.0, 11.0])
+        read_days, values = store.read(1, 'e', self.day, self.day + datetime.timedelta(days=200))
+        self.assertEqual(read_days, days + [self.day + datetime.timedelta(days=100)])
+        self.assertEqual(list(values), [10.0, 2.0, 3.0, 4.0, 5.0, 11.0])
+
+        store.remove(1)
+        self.assertIsNone(store.read(1, 'e', self.day, self.day))
+
+    def testModelReadsFromStore(self):
+        """ Once refreshed, scores come from the store and match the database """
+        model = Model.query.get(1)
+        start = self.day + datetime.timedelta(days=3)
+        end = self.day + datetime.timedelta(days=35)
+        expected = model.get_smoothed_scores(start, end, 'e', 'day', 5)
+        self.assertIsInstance(expected[0][0], ModelScore)
+        expected_weeks = [s.day for s in model.get_scores(start, end, 'e', 'week')]
+
+        refresh_score_store(model)
+        stored = model.get_smoothed_scores(start, end, 'e', 'day', 5)
+        self.assertIsInstance(stored[0][0], StoredScore)
+        self.assertEqual([(s.day, s.value) for s, v in stored], [(s.day, s.value) for s, v in expected])
+        for (s, value), (_, expected_value) in zip(stored, expected):
+            self.assertAlmostEqual(value, expected_value)
+        self.assertEqual([s.day for s in model.get_scores(start, end, 'e', 'week')], expected_weeks)
+
+        # New scores only show up once the store has been refreshed
+        db.engine.execute('update model_score set value = 100 where day = "2018-01-10"')
+        self.assertNotEqual(model.get_scores(self.day, self.day + datetime.timedelta(days=10), 'e', 'day')[-2].value, 100)
+        refresh_score_store(model, self.day + datetime.timedelta(days=9), self.day + datetime.timedelta(days=9))
+        self.assertEqual(model.get_scores(self.day, self.day + datetime.timedelta(days=10), 'e', 'day')[-2].value, 100)
+
+        rebuild_score_store(model)
+        self.assertEqual(len(model.get_scores(self.day, end, 'e', 'day')), model.scores.filter(ModelScore.day <= end).count())
+
+
+    def testPartialRefresh(self):
+        """ A series' first copy is of all its scores, even from a refresh of a few days """
+        model = Model.query.get(1)
+        day = self.day + datetime.timedelta(days=30)
+        refresh_score_store(model, day, day)
+        self.assertEqual(len(model.get_stored_scores(self.day, day, 'e')), model.scores.filter(ModelScore.day <= day).count())
+
+    def testDeletedScores(self):
+        """ Refreshing marks the days whose scores were deleted as missing """
+        model = Model.query.get(1)
+        refresh_score_store(model)
+        end = self.day + datetime.timedelta(days=39)
+        count = len(model.get_stored_scores(self.day, end, 'e'))
+        db.engine.execute('delete from model_score where day in ("2018-01-10", "2018-01-12")')
+        refresh_score_store(model, self.day + datetime.timedelta(days=8), self.day + datetime.timedelta(days=12))
+        days = [s.day for s in model.get_stored_scores(self.day, end, 'e')]
+        self.assertEqual(len(days), count - 2)
+        self.assertNotIn(datetime.date(2018, 1, 10), days)
+        self.assertIn(datetime.date(2018, 1, 11), days)
+
+        db.engine.execute('delete from model_score')
+        refresh_score_store(model)
+        self.assertEqual(model.get_stored_scores(self.day, end, 'e'), [])
+
+if __name__ == '__main__':
+    unittest.main()